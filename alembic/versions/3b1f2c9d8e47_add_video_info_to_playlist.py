@@ -0,0 +1,38 @@
+"""add video info columns to playlist entries
+
+Revision ID: 3b1f2c9d8e47
+Revises: 181a3c7ab60b
+Create Date: 2013-07-02 18:42:10.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b1f2c9d8e47'
+down_revision = '181a3c7ab60b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+	# These start out NULL for existing entries. Run backfill_videos.py to fill them in.
+	op.add_column(
+		"playlist_entries",
+		sa.Column("title", sa.String(255), nullable=True),
+	)
+
+	op.add_column(
+		"playlist_entries",
+		sa.Column("author", sa.String(255), nullable=True),
+	)
+
+	op.add_column(
+		"playlist_entries",
+		sa.Column("duration", sa.Integer, nullable=True),
+	)
+
+
+def downgrade():
+	op.drop_column("playlist_entries", "title")
+	op.drop_column("playlist_entries", "author")
+	op.drop_column("playlist_entries", "duration")
@@ -0,0 +1,48 @@
+"""spread playlist positions apart
+
+Revision ID: 4d2e7a1c5b90
+Revises: 3b1f2c9d8e47
+Create Date: 2013-07-06 14:05:51.702143
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d2e7a1c5b90'
+down_revision = '3b1f2c9d8e47'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import table, column
+
+# This has to match POSITION_GAP in synctron/room.py.
+POSITION_GAP = 1024
+
+entries = table("playlist_entries",
+	column("id", sa.Integer),
+	column("room_id", sa.Integer),
+	column("position", sa.Integer),
+)
+
+
+def upgrade():
+	# Positions used to be indices, so they're already in order. Just spread them out.
+	op.execute(entries.update().values({ "position": (entries.c.position + 1) * POSITION_GAP }))
+
+	op.create_index("ix_playlist_entries_room_position", "playlist_entries", ["room_id", "position"])
+
+
+def downgrade():
+	op.drop_index("ix_playlist_entries_room_position", "playlist_entries")
+
+	# Turn the positions back into indices, room by room.
+	conn = op.get_bind()
+	rows = conn.execute(sa.select([entries.c.id, entries.c.room_id])
+		.order_by(entries.c.room_id, entries.c.position)).fetchall()
+
+	room_id = None
+	for row in rows:
+		if row.room_id != room_id:
+			room_id = row.room_id
+			index = 0
+		conn.execute(entries.update().where(entries.c.id == row.id).values({ "position": index }))
+		index += 1
@@ -0,0 +1,66 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Fills in the title, author, and duration of playlist entries that were added before
+that information was stored in the database.
+
+Videos are looked up in batches through the video info cache, and each batch is
+committed as it's done, so this can be stopped and re-run at any time.
+
+This uses the same settings as the server, so SYNC_SETTINGS has to point at its settings
+file. Importing synctron doesn't start any of the server's greenlets (see synctron.start).
+"""
+
+from synctron import db
+from synctron.room import PlaylistEntry
+from synctron.vidinfo import get_video_infos, VIDEO_BATCH_SIZE
+
+def backfill_videos():
+	dbsession = db.Session(db.engine)
+	filled = 0
+	unavailable = 0
+	last_id = 0
+	try:
+		while True:
+			entries = dbsession.query(PlaylistEntry) \
+				.filter(PlaylistEntry.duration == None, PlaylistEntry.id > last_id) \
+				.order_by(PlaylistEntry.id).limit(VIDEO_BATCH_SIZE).all()
+			if len(entries) == 0:
+				break
+			last_id = entries[-1].id
+
+			infos = get_video_infos([entry.video_id for entry in entries])
+			for entry in entries:
+				info = infos[entry.video_id]
+				if info is None:
+					# The video doesn't exist anymore. Leave the entry alone.
+					unavailable += 1
+				else:
+					entry.set_video_info(info)
+					filled += 1
+			dbsession.commit()
+	finally:
+		dbsession.close()
+
+	print "Backfilled %d playlist entries. %d entries refer to videos that no longer exist." % (filled, unavailable)
+
+if __name__ == "__main__":
+	backfill_videos()
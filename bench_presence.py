@@ -0,0 +1,98 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Measures how long the presence store's operations take against a real redis server.
+
+Fills redis with the given number of rooms, each with a user set from each of the given
+number of workers, then times joining, leaving, reading the top rooms, and a full
+reconciliation pass, along with the number of round trips each one makes.
+
+This writes to the redis database in SYNC_SETTINGS, so point REDIS_URL at an empty database
+that isn't used for anything else. It refuses to run if the database isn't empty, and empties
+it again when it's done.
+"""
+
+from synctron import red, workerid
+from synctron.presence import presence_stats, store_join, store_leave, read_top_rooms, read_user_sets, \
+	write_worker_sets
+
+import argparse
+import sys
+import time
+import uuid
+
+USERSET_TTL = 60
+
+def populate(rooms, workers, users):
+	"""
+	Creates the given number of rooms, each with a user set of the given size from each of the given number of
+	workers. This worker is one of them, and its user sets are returned.
+	"""
+	worker_ids = [str(workerid)] + [str(uuid.uuid4()) for i in range(workers - 1)]
+	for room in range(rooms):
+		slug = "bench%d" % room
+		pipe = red.pipeline(transaction=False)
+		for worker_id in worker_ids[1:]:
+			uset_key = "room:%s:%s" % (slug, worker_id)
+			pipe.sadd(uset_key, *["user%d-%s" % (user, worker_id[:8]) for user in range(users)])
+			pipe.expire(uset_key, USERSET_TTL)
+			pipe.sadd("room:%s" % slug, uset_key)
+		pipe.sadd("rooms", slug)
+		pipe.execute()
+
+	user_sets = dict(("bench%d" % room, set("user%d" % user for user in range(users))) for room in range(rooms))
+	write_worker_sets(user_sets, USERSET_TTL)
+	return user_sets
+
+def measure(name, func, repeat):
+	"""Calls the given function the given number of times and prints how long it took and how many round trips."""
+	round_trips = presence_stats["round_trips"]
+	start = time.time()
+	for i in range(repeat):
+		func(i)
+	elapsed = time.time() - start
+	print "%-16s %10.3f ms %8.1f round trips" % (name, elapsed * 1000 / repeat,
+		float(presence_stats["round_trips"] - round_trips) / repeat)
+
+def bench_presence(rooms, workers, users, repeat):
+	if red.dbsize() != 0:
+		print "The redis database isn't empty. Point REDIS_URL at an empty database."
+		sys.exit(1)
+
+	try:
+		print "Populating %d rooms with %d workers of %d users each..." % (rooms, workers, users)
+		user_sets = populate(rooms, workers, users)
+
+		measure("join", lambda i: store_join("bench%d" % (i % rooms), "joiner%d" % i, USERSET_TTL, "Bench", False), repeat)
+		measure("leave", lambda i: store_leave("bench%d" % (i % rooms), "joiner%d" % i), repeat)
+		measure("top rooms", lambda i: read_top_rooms(10), repeat)
+		measure("reconcile", lambda i: read_user_sets(user_sets.keys()), max(repeat / 10, 1))
+	finally:
+		red.flushdb()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the redis presence store.")
+	parser.add_argument("--rooms", type=int, default=1000)
+	parser.add_argument("--workers", type=int, default=4)
+	parser.add_argument("--users", type=int, default=10)
+	parser.add_argument("--repeat", type=int, default=100)
+	args = parser.parse_args()
+	bench_presence(args.rooms, args.workers, args.users, args.repeat)
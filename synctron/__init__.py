@@ -25,6 +25,7 @@ from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from synctron.sessioninterface import ItsdangerousSessionInterface
+from synctron.registry import ConnectionRegistry
 
 import uuid
 
@@ -48,14 +49,36 @@ workerid = uuid.uuid4()
 app.logger.info("Loading redis...")
 red = StrictRedis.from_url(app.config.get("REDIS_URL"))
 
-# Stupid array for keeping track of connected users.
+# Registry for keeping track of connected users, indexed by the room they're in.
 # It has to be in here to prevent stupid circular imports.
-connections = []
+connections = ConnectionRegistry()
 
 import synctron.views
 
-from synctron.room import userset_greenlet
-app.logger.info("Starting userset polling...")
-gevent_spawn(userset_greenlet)
+def start():
+	"""
+	Creates any missing database tables and starts this worker's background greenlets.
+	This is done before the app handles its first request, so scripts can import synctron to use the database and
+	redis without starting anything.
+	"""
+	db.create_all()
 
-import synctron.redis_pubsub
+	from synctron.room import userset_greenlet
+	app.logger.info("Starting userset polling...")
+	gevent_spawn(userset_greenlet)
+
+	from synctron.stats import stats_greenlet
+	app.logger.info("Starting cache stats logging...")
+	gevent_spawn(stats_greenlet)
+
+	from synctron.redis_pubsub import start_redis_pubsub
+	app.logger.info("Starting redis event handling...")
+	start_redis_pubsub()
+
+	from synctron.roomlistsocket import start_room_list
+	start_room_list()
+
+	from synctron.scheduler import start_scheduler
+	start_scheduler()
+
+app.before_first_request(start)
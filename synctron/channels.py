@@ -0,0 +1,72 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Redis pubsub channels used to pass events between workers.
+
+Each room publishes its events on its own channel, and a worker is only subscribed to the
+channels of rooms that it has users connected to. Changes to the room list, which every
+worker needs to hear about, are published on ROOM_LIST_CHANNEL.
+"""
+
+from synctron import red
+
+# Channel that's published to whenever the number of users in a room changes.
+ROOM_LIST_CHANNEL = "roomlist"
+
+# The PubSub object that this worker receives events on.
+pubsub = red.pubsub()
+
+# Set of the channels that this worker is subscribed to.
+subscribed_channels = set()
+
+def room_channel(room_slug):
+	"""Returns the name of the channel that the given room's events are published on."""
+	return "room:%s:events" % room_slug
+
+def subscribe(channel):
+	"""Subscribes this worker to the given channel."""
+	if channel not in subscribed_channels:
+		subscribed_channels.add(channel)
+		pubsub.subscribe(channel)
+
+def unsubscribe(channel):
+	"""Unsubscribes this worker from the given channel."""
+	if channel in subscribed_channels:
+		subscribed_channels.discard(channel)
+		pubsub.unsubscribe(channel)
+
+def resubscribe():
+	"""
+	Re-subscribes to all of this worker's channels.
+	This is used to recover after the pubsub connection is lost.
+	"""
+	pubsub.reset()
+	if len(subscribed_channels) > 0:
+		pubsub.subscribe(*subscribed_channels)
+
+def watched_rooms():
+	"""Returns a list of the slugs of the rooms whose events this worker is subscribed to."""
+	return [channel[len("room:"):-len(":events")] for channel in subscribed_channels
+		if channel.startswith("room:") and channel.endswith(":events")]
+
+def is_watching(room_slug):
+	"""Returns True if this worker is subscribed to the given room's events."""
+	return room_channel(room_slug) in subscribed_channels
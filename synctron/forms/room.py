@@ -25,6 +25,7 @@ Forms related to creating and managing rooms.
 from synctron import app, db
 from synctron.user import User
 from synctron.room import Room
+from synctron.presence import store_room_meta
 
 from flask import render_template, redirect, abort, url_for, request, session
 from flask.ext.wtf import Form, RecaptchaField
@@ -131,6 +132,7 @@ def room_settings(slug):
 		# Set fields in the room and commit to the database.
 		form.populate_obj(room)
 		db.session.commit()
+		store_room_meta(room.slug, room.title, room.is_private)
 		message = "Room settings saved successfully."
 		msg_type = "success"
 		msg_timeout = 3000
@@ -0,0 +1,43 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Helpers for sending the same Socket.IO event to many connections.
+
+BaseNamespace.emit encodes its packet separately for every connection it's called on. When
+the same event is going out to a lot of connections, it's much cheaper to encode the packet
+once and put the encoded bytes straight onto each connection's queue.
+"""
+
+from socketio import packet
+
+def encode_event(endpoint, event, *args):
+	"""
+	Encodes a Socket.IO event packet for the given namespace endpoint (such as "/room").
+	The result can be passed to send_encoded.
+	"""
+	return packet.encode(dict(type="event", name=event, args=args, endpoint=endpoint))
+
+def send_encoded(connections, data):
+	"""
+	Sends an already encoded packet to each of the given namespace connections.
+	"""
+	for connection in connections:
+		connection.socket.put_client_msg(data)
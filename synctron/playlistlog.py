@@ -0,0 +1,116 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Redis storage for room playlist versions and change logs.
+
+Every change to a room's playlist increments its version, which is kept under the key
+playlist:<slug>:version. Changes that clients can apply on their own (adding, removing and
+moving videos) are also pushed onto the room's change log, playlist:<slug>:log, which holds
+the most recent PLAYLIST_LOG_SIZE changes, newest first. Changes that replace the whole
+playlist, like shuffling, clear the log instead.
+
+When a client reconnects, it sends the version of the playlist it has, and if the log still
+covers every change since then, it only gets sent those changes instead of the whole playlist.
+"""
+
+from synctron import app, red
+
+import json
+
+# Maximum number of changes kept in each room's change log.
+PLAYLIST_LOG_SIZE = app.config.get("PLAYLIST_LOG_SIZE", 200)
+
+# Number of seconds a room's change log is kept for after its last change.
+# Versions are kept forever, so that they never go backwards.
+PLAYLIST_LOG_TTL = 24 * 60 * 60
+
+# Lua script that increments the version of a playlist, records a change to it, and publishes the change.
+# Doing all of that in one script means changes are always published in version order.
+# KEYS[1] is the version key, KEYS[2] is the log key, and KEYS[3] is the channel to publish on.
+# ARGV[1] is the JSON encoded change, or an empty string if the change can't be applied incrementally,
+# in which case the log is cleared.
+# ARGV[2] is the maximum number of changes to keep in the log (PLAYLIST_LOG_SIZE).
+# ARGV[3] is the number of seconds to keep the log for (PLAYLIST_LOG_TTL).
+# ARGV[4] is the JSON encoded message object to publish, which gets the new version added to it as its "version" field.
+# Log entries are the change's version, a space, and the change.
+# Returns the new version.
+_publish_change = red.register_script("""
+local version = redis.call("INCR", KEYS[1])
+if ARGV[1] == "" then
+	redis.call("DEL", KEYS[2])
+else
+	redis.call("LPUSH", KEYS[2], version .. " " .. ARGV[1])
+	redis.call("LTRIM", KEYS[2], 0, tonumber(ARGV[2]) - 1)
+	redis.call("EXPIRE", KEYS[2], ARGV[3])
+end
+local message = cjson.decode(ARGV[4])
+message["version"] = version
+redis.call("PUBLISH", KEYS[3], cjson.encode(message))
+return version
+""")
+
+def version_key(room_slug):
+	"""Returns the key of the given room's playlist version."""
+	return "playlist:%s:version" % room_slug
+
+def log_key(room_slug):
+	"""Returns the key of the given room's playlist change log."""
+	return "playlist:%s:log" % room_slug
+
+def publish_playlist_change(room_slug, channel, message, change=None):
+	"""
+	Increments the given room's playlist version, adds the given change dict to its change log, and publishes the
+	given message dict on the given channel with the new version added to it.
+	If change is None, the change log is cleared instead.
+	Returns the new version.
+	"""
+	data = "" if change is None else json.dumps(change)
+	return _publish_change(keys=[version_key(room_slug), log_key(room_slug), channel],
+		args=[data, PLAYLIST_LOG_SIZE, PLAYLIST_LOG_TTL, json.dumps(message)])
+
+def read_playlist_version(room_slug):
+	"""Returns the given room's current playlist version."""
+	return int(red.get(version_key(room_slug)) or 0)
+
+def read_playlist_changes(room_slug, since_version, to_version):
+	"""
+	Returns a list of the changes made to the given room's playlist after since_version, up to and including to_version,
+	oldest first.
+	Returns None if the change log doesn't go back far enough to cover them all.
+	"""
+	if since_version == to_version:
+		return []
+	if since_version > to_version:
+		return None
+
+	changes = []
+	for item in red.lrange(log_key(room_slug), 0, -1):
+		version, data = item.split(" ", 1)
+		version = int(version)
+		if version <= since_version:
+			break
+		if version <= to_version:
+			changes.append((version, data))
+
+	changes.reverse()
+	if len(changes) == 0 or changes[0][0] != since_version + 1 or changes[-1][0] != to_version:
+		return None
+	return [json.loads(data) for version, data in changes]
@@ -0,0 +1,285 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Redis storage for room user sets.
+
+Each worker keeps a set of the users it has connected to each room in redis, under the key
+room:<slug>:<workerid>. The keys of a room's user sets are kept in the room:<slug> set, the
+slugs of rooms with users in them are kept in the rooms set, and worker:<workerid> is a hash
+mapping room slugs to that worker's user set keys.
+
+The number of users in each public room is kept in the rooms:usercount sorted set, so the
+most popular rooms can be found without looking at every room. Room titles are cached in the
+rooms:meta hash and the slugs of private rooms are kept in the rooms:private set.
+
+Every function in here costs a constant number of round trips to redis, except for read_user_sets,
+which costs three round trips for every RECONCILE_BATCH_SIZE rooms. The number of round trips
+made is counted in presence_stats.
+
+The Lua scripts only touch keys that are passed to them in KEYS. The keys of a room's user sets
+aren't known until the room:<slug> set is read, so that's read first, in its own round trip.
+"""
+
+from synctron import app, red, workerid
+
+# Counters for the number of redis round trips made by the presence store.
+presence_stats = { "round_trips": 0 }
+
+# Number of rooms whose user sets are cleaned up by each script call while reconciling.
+RECONCILE_BATCH_SIZE = app.config.get("RECONCILE_BATCH_SIZE", 100)
+
+# Lua function that counts the users in the user sets with the given keys and updates the given room's score in the
+# sorted set with the given key. Rooms that are empty or in the set of private rooms with the given key are taken out.
+_UPDATE_USER_COUNT = """
+local function update_user_count(slug, private_key, usercount_key, uset_keys)
+	local count = 0
+	if #uset_keys > 0 then
+		count = #redis.call("SUNION", unpack(uset_keys))
+	end
+	if count > 0 and redis.call("SISMEMBER", private_key, slug) == 0 then
+		redis.call("ZADD", usercount_key, count, slug)
+	else
+		redis.call("ZREM", usercount_key, slug)
+	end
+	return count
+end
+"""
+
+# Lua script that updates the user count of a room.
+# KEYS[1] is rooms:private, KEYS[2] is rooms:usercount, and KEYS[3] onwards are the keys of the room's user sets.
+# ARGV[1] is the room's slug.
+# Returns the room's user count.
+_update_user_count = red.register_script(_UPDATE_USER_COUNT + """
+local uset_keys = {}
+for i = 3, #KEYS do
+	table.insert(uset_keys, KEYS[i])
+end
+return update_user_count(ARGV[1], KEYS[1], KEYS[2], uset_keys)
+""")
+
+# Lua function that reads the user sets with the given keys and takes the empty or expired ones out of the room set
+# with the given key. Returns a list of [uset_key, [username, ...]] lists.
+_READ_ROOM = """
+local function read_room(room_key, uset_keys)
+	local usets = {}
+	for _, uset_key in ipairs(uset_keys) do
+		local members = redis.call("SMEMBERS", uset_key)
+		if #members > 0 then
+			table.insert(usets, { uset_key, members })
+		else
+			redis.call("SREM", room_key, uset_key)
+		end
+	end
+	return usets
+end
+"""
+
+# Lua script that reads the user sets of a room.
+# KEYS[1] is the room's room:<slug> set and KEYS[2] onwards are the keys of its user sets.
+# Returns a list of [uset_key, [username, ...]] lists.
+_read_room_user_sets = red.register_script(_READ_ROOM + """
+local uset_keys = {}
+for i = 2, #KEYS do
+	table.insert(uset_keys, KEYS[i])
+end
+return read_room(KEYS[1], uset_keys)
+""")
+
+# Lua script that cleans up the user sets of a room and updates its user count.
+# The room is taken out of the rooms set if it has no user sets left.
+# KEYS[1] is rooms, KEYS[2] is rooms:private, KEYS[3] is rooms:usercount, KEYS[4] is the room's room:<slug> set, and
+# KEYS[5] onwards are the keys of its user sets.
+# ARGV[1] is the room's slug.
+# Returns a list of [uset_key, [username, ...]] lists.
+_reconcile_room = red.register_script(_UPDATE_USER_COUNT + _READ_ROOM + """
+local uset_keys = {}
+for i = 5, #KEYS do
+	table.insert(uset_keys, KEYS[i])
+end
+local usets = read_room(KEYS[4], uset_keys)
+if redis.call("SCARD", KEYS[4]) == 0 then
+	redis.call("SREM", KEYS[1], ARGV[1])
+end
+
+local live_keys = {}
+for _, uset in ipairs(usets) do
+	table.insert(live_keys, uset[1])
+end
+update_user_count(ARGV[1], KEYS[2], KEYS[3], live_keys)
+return usets
+""")
+
+# Lua script that returns the top rooms and their titles.
+# KEYS[1] is rooms:usercount and KEYS[2] is rooms:meta. ARGV[1] is the number of rooms to return.
+# Returns a flat list of slug, user count, title triples.
+_top_rooms = red.register_script("""
+local result = {}
+local top = redis.call("ZREVRANGE", KEYS[1], 0, tonumber(ARGV[1]) - 1, "WITHSCORES")
+for i = 1, #top, 2 do
+	table.insert(result, top[i])
+	table.insert(result, top[i + 1])
+	table.insert(result, redis.call("HGET", KEYS[2], top[i]) or top[i])
+end
+return result
+""")
+
+def room_key(room_slug):
+	"""Returns the key of the set of the given room's user set keys."""
+	return "room:%s" % room_slug
+
+def userset_key(room_slug):
+	"""Returns the key of this worker's user set for the given room."""
+	return "room:%s:%s" % (room_slug, str(workerid))
+
+def worker_key():
+	"""Returns the key of this worker's user set hash."""
+	return "worker:%s" % str(workerid)
+
+def _queue_room_keys(pipe, room_slug, ttl):
+	"""Queues the commands that register this worker's user set for the given room on the given pipeline."""
+	uset_key = userset_key(room_slug)
+	pipe.expire(uset_key, ttl)
+	pipe.sadd(room_key(room_slug), uset_key)
+	pipe.sadd("rooms", room_slug)
+	pipe.hset(worker_key(), room_slug, uset_key)
+
+def _queue_room_meta(pipe, room_slug, title, is_private):
+	"""Queues the commands that cache the given room's metadata on the given pipeline."""
+	pipe.hset("rooms:meta", room_slug, title)
+	if is_private:
+		pipe.sadd("rooms:private", room_slug)
+	else:
+		pipe.srem("rooms:private", room_slug)
+
+def _execute_and_update_user_count(pipe, room_slug):
+	"""
+	Executes the given pipeline, then updates the given room's user count.
+	The room's user set keys are read by the pipeline, so this costs two round trips.
+	"""
+	pipe.smembers(room_key(room_slug))
+	uset_keys = pipe.execute()[-1]
+	_update_user_count(keys=["rooms:private", "rooms:usercount"] + list(uset_keys), args=[room_slug])
+	presence_stats["round_trips"] += 2
+
+def store_join(room_slug, username, ttl, title, is_private):
+	"""
+	Adds the given user to this worker's user set for the given room and updates the room's user count.
+	The room's title and privacy setting are cached along with its user count.
+	"""
+	pipe = red.pipeline()
+	pipe.sadd(userset_key(room_slug), username)
+	_queue_room_keys(pipe, room_slug, ttl)
+	_queue_room_meta(pipe, room_slug, title, is_private)
+	_execute_and_update_user_count(pipe, room_slug)
+
+def store_leave(room_slug, username):
+	"""
+	Removes the given user from this worker's user set for the given room and updates the room's user count.
+	"""
+	pipe = red.pipeline()
+	pipe.srem(userset_key(room_slug), username)
+	_execute_and_update_user_count(pipe, room_slug)
+
+def store_room_meta(room_slug, title, is_private):
+	"""
+	Updates the cached metadata for the given room, adding or removing it from rooms:usercount if its privacy changed.
+	"""
+	pipe = red.pipeline()
+	_queue_room_meta(pipe, room_slug, title, is_private)
+	_execute_and_update_user_count(pipe, room_slug)
+
+def read_top_rooms(count):
+	"""
+	Returns a list of (slug, title, user count) tuples for the given number of public rooms with the most users.
+	"""
+	result = _top_rooms(keys=["rooms:usercount", "rooms:meta"], args=[count])
+	presence_stats["round_trips"] += 1
+	return [(result[i], result[i + 2], int(float(result[i + 1]))) for i in range(0, len(result), 3)]
+
+def write_worker_sets(user_sets, ttl):
+	"""
+	Re-writes all of this worker's user sets and renews their TTLs.
+	user_sets should be a dict mapping room slugs to collections of usernames.
+	"""
+	pipe = red.pipeline()
+	for room_slug, usernames in user_sets.iteritems():
+		pipe.delete(userset_key(room_slug))
+		if len(usernames) > 0:
+			pipe.sadd(userset_key(room_slug), *usernames)
+		_queue_room_keys(pipe, room_slug, ttl)
+	pipe.expire(worker_key(), ttl)
+	pipe.execute()
+	presence_stats["round_trips"] += 1
+
+def _worker_sets(usets):
+	"""Converts a list of [uset_key, [username, ...]] lists into a dict mapping worker IDs to sets of usernames."""
+	return dict((uset_key.rsplit(":", 1)[1], set(members)) for uset_key, members in usets)
+
+def _read_uset_keys(room_slugs):
+	"""Returns a list of the lists of user set keys of each of the given rooms."""
+	pipe = red.pipeline(transaction=False)
+	for room_slug in room_slugs:
+		pipe.smembers(room_key(room_slug))
+	result = pipe.execute()
+	presence_stats["round_trips"] += 1
+	return [list(uset_keys) for uset_keys in result]
+
+def _reconcile_rooms(room_slugs):
+	"""
+	Cleans up the user sets and user counts of the given rooms, with one script call for each room.
+	Returns a list of the lists of [uset_key, [username, ...]] lists for each of the given rooms.
+	"""
+	pipe = red.pipeline(transaction=False)
+	for room_slug, uset_keys in zip(room_slugs, _read_uset_keys(room_slugs)):
+		_reconcile_room(keys=["rooms", "rooms:private", "rooms:usercount", room_key(room_slug)] + uset_keys,
+			args=[room_slug], client=pipe)
+	result = pipe.execute()
+	presence_stats["round_trips"] += 1
+	return result
+
+def read_user_sets(room_slugs):
+	"""
+	Cleans up the user sets and user counts of every room, and reads every worker's user sets for the given rooms.
+	Rooms are scanned and cleaned up RECONCILE_BATCH_SIZE at a time, so redis is never blocked for long.
+	Returns a dict mapping room slugs to dicts that map worker IDs to sets of usernames.
+	"""
+	wanted = set(room_slugs)
+	user_sets = {}
+	cursor = 0
+	while True:
+		cursor, batch = red.sscan("rooms", cursor, count=RECONCILE_BATCH_SIZE)
+		presence_stats["round_trips"] += 1
+		if len(batch) > 0:
+			for room_slug, usets in zip(batch, _reconcile_rooms(batch)):
+				if room_slug in wanted:
+					user_sets[room_slug] = _worker_sets(usets)
+		if int(cursor) == 0:
+			return user_sets
+
+def read_room_user_sets(room_slug):
+	"""
+	Reads every worker's user set for the given room.
+	Returns a dict mapping worker IDs to sets of usernames.
+	"""
+	uset_keys = _read_uset_keys([room_slug])[0]
+	result = _read_room_user_sets(keys=[room_key(room_slug)] + uset_keys)
+	presence_stats["round_trips"] += 1
+	return _worker_sets(result)
@@ -19,108 +19,228 @@
 # THE SOFTWARE.
 
 from synctron import app, db
-from synctron.room import Room, userset_update, user_info_dict, guest_info_dict
-from synctron.user import User
+from synctron.room import apply_presence, local_user_counts, load_room_user_sets, forget_room_user_sets
 from synctron.roomlistsocket import broadcast_room_user_list_update
+from synctron.roomstate import get_room_state, cached_room_state, invalidate_room_state
+from synctron.scheduler import schedule_room, forget_room
+from synctron.channels import ROOM_LIST_CHANNEL, pubsub, room_channel, subscribe, unsubscribe, resubscribe, \
+	is_watching, watched_rooms
 
-from redis import StrictRedis
+from redis.exceptions import ConnectionError
 
 import gevent
 import json
 
-def synchronize_all(data, room, dbsession):
+def watch_room(room):
+	"""
+	Subscribes this worker to the given room's events, if it isn't already.
+	This should be called before the first user on this worker is added to the room.
+	"""
+	if is_watching(room.slug):
+		return
+	subscribe(room_channel(room.slug))
+
+	# We haven't been hearing this room's events, so catch up on its users and when its video ends.
+	load_room_user_sets(room.slug)
+	schedule_room(room)
+
+def unwatch_room(room_slug):
+	"""
+	Unsubscribes this worker from the given room's events if there are no users left in it on this worker.
+	"""
+	if room_slug in local_user_counts or not is_watching(room_slug):
+		return
+	unsubscribe(room_channel(room_slug))
+	forget_room(room_slug)
+	forget_room_user_sets(room_slug)
+	invalidate_room_state(room_slug)
+
+def reload_watched_rooms():
+	"""
+	Re-loads the state of every room this worker is watching from the database, re-arms their deadlines, and sends
+	the new state to their users. This is done after re-subscribing, since any events published while this worker
+	wasn't subscribed were missed.
+	"""
+	dbsession = db.Session(db.engine)
+	try:
+		for room_slug in watched_rooms():
+			old_state = cached_room_state(room_slug)
+			invalidate_room_state(room_slug)
+			state = get_room_state(room_slug, dbsession)
+			if state is None:
+				continue
+
+			schedule_room(state)
+			state.emit_config_update()
+			state.emit_playlist_update()
+			if old_state is None or old_state.current_video_id != state.current_video_id:
+				state.emit_video_changed()
+			else:
+				state.emit_synchronize()
+	finally:
+		dbsession.close()
+
+# Room.save and Room.pub_config_update apply changes to this worker's state as they're made, but the state carried by
+# every message, including this worker's own, is applied again when it arrives. Messages arrive in the order they were
+# published, so the state always ends up matching the last one, even when another worker's change was published before
+# this worker's but arrives after it was applied locally.
+
+def synchronize_all(data, state):
 	"""Message sent to tell Synctron to sync all users in the given room."""
-	room.emit_synchronize()
+	state.apply_playback(data["playback"])
+	schedule_room(state)
+	state.emit_synchronize()
 
-def video_changed(data, room, dbsession):
+def video_changed(data, state):
 	"""Message sent to tell Synctron that the video in the given room changed."""
-	room.emit_video_changed()
+	state.apply_playback(data["playback"])
+	schedule_room(state)
+	state.emit_video_changed()
 
-def playlist_change(data, room, dbsession):
+def playlist_change(data, state):
 	"""Message sent to tell Synctron that the playlist changed."""
 	# TODO: Handle thrown errors.
+	# The playlist position is part of the playback state, so like the other playback messages, it's applied from
+	# every message in the order they arrive.
+	state.playlist_position = data["playlist_position"]
+
+	# Changes are published in version order, so if the state's version isn't behind this change, it was either
+	# applied when this worker made it or loaded after it was made, and the state already includes it.
+	if data["version"] <= state.playlist_version:
+		schedule_room(state)
+		return
+
+	# If the state is missing earlier changes, this one can't be applied on top of it, so the whole playlist is
+	# re-loaded instead. That includes this change.
+	if data["version"] != state.playlist_version + 1:
+		state.reload_playlist()
+		state.emit_playlist_update()
+		schedule_room(state)
+		return
+
+	state.playlist_version = data["version"]
+	state.invalidate_playlist_snapshot()
+
 	change_type = data["change_type"]
 	if change_type == "update":
-		room.emit_playlist_update()
+		# The message is re-encoded by redis's cjson, which turns an empty playlist into an empty object.
+		state.playlist = data["playlist"] or []
+		state.emit_playlist_update()
 	elif change_type == "add":
-		room.emit_video_added(data["entry"], data["index"])
+		entry = data["entry"]
+		state.playlist.insert(data["index"], entry)
+		state.emit_video_added(entry, data["index"])
+	elif change_type == "add_many":
+		index = data["index"]
+		state.playlist[index:index] = data["entries"]
+		state.emit_videos_added(data["entries"], index)
 	elif change_type == "remove":
-		room.emit_videos_removed(data["indices"])
+		for index in sorted(data["indices"], reverse=True):
+			del state.playlist[index]
+		state.emit_videos_removed(data["indices"])
 	elif change_type == "move":
-		room.emit_video_moved(data["old_index"], data["new_index"])
+		state.playlist.insert(data["new_index"], state.playlist.pop(data["old_index"]))
+		state.emit_video_moved(data["old_index"], data["new_index"])
 	else:
 		raise ValueError("Invalid playlist change type detected.")
-
-def userlist_update(data, room, dbsession):
-	"""Message sent to tell Synctron that the user list changed."""
-	userset_update()
-	broadcast_room_user_list_update()
-
-def chat_message(data, room, dbsession):
+	schedule_room(state)
+
+def presence(data, state):
+	"""Message sent to tell Synctron that a user joined or left a room on one of the workers."""
+	joined = data.get("joined")
+	left = data.get("left")
+	if apply_presence(state.slug, data["worker"], joined=joined, left=left):
+		if joined is not None:
+			state.emit_user_joined(data["joined_info"])
+		if left is not None:
+			state.emit_user_left(left)
+
+def chat_message(data, state):
 	"""Message sent to tell Synctron that a chat or status message was sent."""
 	# TODO: Handle thrown errors.
 	message_type = data["message_type"]
 	if message_type == "chat":
-		user = None
-		if not data["user"].startswith("Guest "):
-			user = dbsession.query(User).filter_by(name=data["user"]).first()
+		state.emit_chat_message(data["message"], data["user"], "action" in data and data["action"])
+	elif message_type == "status":
+		state.emit_status_message(data["message"], data["msgtype"])
 
-		room.emit_chat_message(data["message"], 
-			user_info_dict(user, room) if user is not None else guest_info_dict(data["user"], room), 
-			"action" in data and data["action"])
-	elif message.type == "status":
-		room.emit_status_message(data["message"], data["msgtype"])
-
-def config_update(data, room, dbsession):
+def config_update(data, state):
 	"""Message sent to tell Synctron that the room's settings have changed."""
-	room.emit_config_update()
-
+	state.apply_config(data["config"])
+	state.emit_config_update()
+
+
+def handle_message(message):
+	"""Processes a single PubSub message from Redis."""
+	if message["type"] != "message":
+		return
+
+	if message["channel"] == ROOM_LIST_CHANNEL:
+		broadcast_room_user_list_update()
+		return
+
+	data = None
+	try:
+		data = json.loads(message["data"])
+	except ValueError:
+		app.logger.error("Received invalid redis event message (invalid JSON): %s" % message["data"])
+		return
+
+	if "room" not in data:
+		app.logger.error("Received invalid redis event message (room field missing): %s" % message["data"])
+	elif "event" not in data or data["event"] not in room_handlers:
+		app.logger.error("Received invalid redis event message (event field missing): %s" % message["data"])
+	else:
+		# Events carry everything needed to handle them, so we just need the room's cached state.
+		# If it isn't cached, nobody on this worker is in the room and there's nothing to do.
+		state = cached_room_state(data["room"])
+		if state is not None:
+			room_handlers[data["event"]](data, state)
 
 def redis_message_loop():
-	"""Loop for processing PubSub messages on Redis."""
-	red = StrictRedis.from_url(app.config.get("REDIS_URL"))
-	ps = red.pubsub()
-	ps.subscribe("rooms")
+	"""
+	Loop for processing PubSub messages on Redis.
+	Blocks on the PubSub connection (cooperatively, since gevent has patched the socket module) and handles
+	each message as soon as it arrives. If the connection is lost, it reconnects and re-subscribes.
+	"""
+	subscribe(ROOM_LIST_CHANNEL)
 
-	message = None
 	while True:
 		try:
-			gevent.sleep(0.25 if message is None else 0)
-
-			message = ps.get_message()
-
-			if message is not None and message["type"] == "message":
-				data = None
-				try:
-					data = json.loads(message["data"])
-				except ValueError:
-					app.logger.error("Received invalid redis event message (invalid JSON): %s" % message["data"])
-
-				dbsession = db.Session(db.engine)
+			for message in pubsub.listen():
 				try:
-					room = None
-					if "room" in data:
-						room = dbsession.query(Room).filter_by(slug=data["room"]).first()
-
-					if room is None:
-						app.logger.error("Received invalid redis event message (given room not found): %s" % message["data"])
-					elif "event" not in data or data["event"] not in room_handlers:
-						app.logger.error("Received invalid redis event message (event field missing): %s" % message["data"])
-					else:
-						room_handlers[data["event"]](data, room, dbsession)
-				finally:
-					dbsession.close()
+					handle_message(message)
+				except:
+					app.logger.error("An error occurred handling a redis message.", exc_info=True)
+		except ConnectionError:
+			app.logger.error("Lost connection to redis. Reconnecting...", exc_info=True)
+			gevent.sleep(1)
+			try:
+				resubscribe()
+			except:
+				app.logger.error("Failed to re-subscribe to redis channels.", exc_info=True)
+				continue
+			try:
+				reload_watched_rooms()
+				broadcast_room_user_list_update()
+			except:
+				app.logger.error("Failed to re-load rooms after re-subscribing.", exc_info=True)
 		except:
 			app.logger.error("An error occurred in the redis message loop.", exc_info=True)
+			gevent.sleep(1)
 
-gevent.spawn(redis_message_loop)
+def start_redis_pubsub():
+	"""
+	Starts the redis message loop greenlet.
+	"""
+	gevent.spawn(redis_message_loop)
 
 
 room_handlers = {
 	"sync": synchronize_all,
 	"video_changed": video_changed,
 	"playlist_change": playlist_change,
-	"userlist_update": userlist_update,
+	"presence": presence,
 	"chat_message": chat_message,
 	"config_update": config_update,
 }
@@ -0,0 +1,62 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Registry of the Socket.IO connections on this worker.
+"""
+
+class ConnectionRegistry(object):
+	"""
+	Keeps track of the room connections on this worker, indexed by the slug of the room they're in.
+	Adding and removing connections and looking up a room's connections are all constant time.
+	"""
+
+	def __init__(self):
+		# Dict mapping room slugs to the set of connections in that room.
+		self._rooms = {}
+
+		# Dict mapping connections to the slug of the room they're in.
+		self._room_of = {}
+
+	def remove(self, connection):
+		"""Removes a connection, taking it out of the room it's in."""
+		self._leave_room(connection)
+
+	def set_room(self, connection, room_slug):
+		"""Moves the given connection into the room with the given slug."""
+		self._leave_room(connection)
+		self._room_of[connection] = room_slug
+		self._rooms.setdefault(room_slug, set()).add(connection)
+
+	def _leave_room(self, connection):
+		room_slug = self._room_of.pop(connection, None)
+		if room_slug is not None:
+			room = self._rooms[room_slug]
+			room.discard(connection)
+			if len(room) == 0:
+				del self._rooms[room_slug]
+
+	def in_room(self, room_slug):
+		"""Returns a list of the connections in the room with the given slug."""
+		return list(self._rooms.get(room_slug, ()))
+
+	def room_count(self, room_slug):
+		"""Returns the number of connections in the room with the given slug."""
+		return len(self._rooms.get(room_slug, ()))
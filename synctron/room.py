@@ -18,52 +18,70 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from sqlalchemy import Table, Column, Integer, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.sql.expression import func
 
 from synctron import app, db, connections, red, workerid
-from synctron.vidinfo import get_video_info
+from synctron.vidinfo import get_video_info, get_video_infos, get_playlist_video_ids
 from synctron.database import Base, admin_association_table, stars_association_table
 from synctron.user import User
+from synctron.roomstate import get_room_state, cached_room_state, invalidate_room_state
+from synctron.presence import presence_stats, store_join, store_leave, write_worker_sets, read_user_sets, read_room_user_sets
+from synctron.channels import ROOM_LIST_CHANNEL, room_channel
+from synctron.playlistlog import publish_playlist_change
 
 from redis import StrictRedis
 
 import time
-from copy import copy
 from random import shuffle
 import json
 
 def get_entry_info(entry):
 	"""
-	Returns a dict containing information about the given playlist entry.
+	Returns a dict containing information about the given playlist entry (see get_entry_infos).
 	"""
-	# Because get_video_info caches video information, and we're going to be adding data to the dict,
-	# we need to make a copy of it first so that the data we add to the dict doesn't get added to the
-	# data that get_video_info has cached.
-	info = copy(get_video_info(entry.video_id))
-	if info is None:
-		return None
-	info["added_by"] = entry.added_by
-	return info
+	return get_entry_infos([entry])[0]
+
+def get_entry_infos(entries):
+	"""
+	Returns a list of dicts containing information about each of the given playlist entries.
+	The video info stored on the entries is used, so this only needs to look videos up for entries
+	that were added before video info was stored and haven't been backfilled yet.
+
+	Entries whose videos don't exist anymore still get a dict, so that the room's cached playlist keeps their video
+	IDs and indices, but their title, author, and duration are None. Everything that uses these dicts has to allow
+	for that: the scheduler and Room.check_video_ended treat a None duration as a video that never ends, the
+	playlist summary counts it as 0, and the client shows the entry as unavailable.
+	"""
+	missing = [entry.video_id for entry in entries if not entry.has_video_info]
+	video_infos = get_video_infos(missing) if len(missing) > 0 else {}
+
+	infos = []
+	for entry in entries:
+		if not entry.has_video_info and video_infos[entry.video_id] is not None:
+			infos.append(dict(video_infos[entry.video_id], added_by=entry.added_by))
+		else:
+			# If the video doesn't exist anymore, its title, author, and duration will just be None.
+			infos.append(entry.info_dict())
+	return infos
 
 
-def user_info_dict(user, room):
+def user_info_dict(user, state):
 	"""
-	Returns a user info dict for the given user and the given room.
-	User should be a database entry.
+	Returns a user info dict for the given user in the room with the given RoomState.
+	User should be a database entry (or a row with id and name columns).
 	"""
 	return {
 		"username": user.name,
 		"isguest": False,
-		"isadmin": user in room.admins,
-		"isowner": room.owner == user,
+		"isadmin": user.id in state.admin_ids,
+		"isowner": state.owner_id == user.id,
 	}
 
-def guest_info_dict(guest_name, room):
+def guest_info_dict(guest_name, state):
 	"""
 	Returns a user info dict for a guest user with the given guest name.
 	"""
@@ -75,9 +93,86 @@ def guest_info_dict(guest_name, room):
 	}
 
 
-# Dict for caching user lists. Updated every few seconds by the userset greenlet.
+# Dict for caching user lists. Maps room slugs to the set of usernames in the room on all workers.
+# Kept up to date by presence events from the workers and reconciled every so often by the userset greenlet.
 userset_dict = {}
-loaded_rooms = set()
+
+# Dict mapping room slugs to dicts that map worker IDs to the set of usernames in the room on that worker.
+worker_usersets = {}
+
+# Dict mapping room slugs to dicts that count how many connections each user has to the room on this worker.
+local_user_counts = {}
+
+# How long (in seconds) a worker's user sets last in redis without being renewed by the userset greenlet.
+USERSET_TTL = 60
+
+# How often (in seconds) the userset greenlet reconciles the user sets with redis.
+USERSET_RECONCILE_INTERVAL = 20
+
+# Playlist entries are ordered by their position column, but positions aren't indices. They're spread
+# POSITION_GAP apart, so that an entry can be inserted between two others by giving it a position in the
+# gap between them, without renumbering every entry after it. When there's no gap left, the whole playlist
+# is renumbered (see Room.rebalance_playlist). Clients only ever see indices.
+POSITION_GAP = 1024
+
+# Maximum number of videos that can be added to a playlist at once.
+BULK_ADD_LIMIT = app.config.get("BULK_ADD_LIMIT", 200)
+
+# Seconds of "padding" added to the end of each video to make sure videos don't seem to end early.
+END_PADDING = 2
+
+# Seconds of "padding" added to the start of each video (see Room.change_video).
+START_PADDING = 3
+
+def apply_presence(room_slug, worker, joined=None, left=None):
+	"""
+	Applies a presence change from the given worker to the user sets.
+	joined and left are the names of the user who joined or left the room on that worker.
+	Returns True if the room's user set changed.
+	"""
+	wsets = worker_usersets.setdefault(room_slug, {})
+	uset = wsets.setdefault(worker, set())
+	if joined is not None:
+		uset.add(joined)
+	if left is not None:
+		uset.discard(left)
+	if len(uset) == 0:
+		del wsets[worker]
+	return update_room_userset(room_slug)
+
+def load_room_user_sets(room_slug):
+	"""
+	Loads every worker's user set for the given room from redis.
+	This is done when this worker starts watching a room, since it won't have heard the room's presence events before that.
+	"""
+	worker_usersets[room_slug] = read_room_user_sets(room_slug)
+	update_room_userset(room_slug)
+
+def forget_room_user_sets(room_slug):
+	"""
+	Forgets the user sets for the given room. This is done when this worker stops watching a room.
+	"""
+	worker_usersets.pop(room_slug, None)
+	userset_dict.pop(room_slug, None)
+
+def update_room_userset(room_slug):
+	"""
+	Re-builds the given room's entry in userset_dict from the user sets of each worker.
+	Returns True if the room's user set changed.
+	"""
+	wsets = worker_usersets.get(room_slug, {})
+	new_set = set().union(*wsets.values())
+	if len(wsets) == 0 and room_slug in worker_usersets:
+		del worker_usersets[room_slug]
+
+	if new_set == userset_dict.get(room_slug, set()):
+		return False
+
+	if len(new_set) > 0:
+		userset_dict[room_slug] = new_set
+	else:
+		del userset_dict[room_slug]
+	return True
 
 class Room(Base):
 	"""
@@ -115,8 +210,8 @@ class Room(Base):
 	playlist_position = Column(Integer, default=0, nullable=True)
 	
 	# Videos in the room's playlist.
-	playlist = relationship("PlaylistEntry", order_by="PlaylistEntry.position",
-							collection_class=ordering_list("position"))
+	# The position of each entry is managed by the playlist operations below, not by the list itself.
+	playlist = relationship("PlaylistEntry", order_by="PlaylistEntry.position")
 
 
 	# List of users who are admins in this room.
@@ -169,10 +264,8 @@ class Room(Base):
 
 	@property
 	def connected_users(self):
-		"""Generator listing users connected to this room on this worker."""
-		for user in connections:
-			if "room" in user.session and user.session["room"] == self.slug:
-				yield user
+		"""List of users connected to this room on this worker."""
+		return connections.in_room(self.slug)
 
 	@property
 	def users(self):
@@ -184,13 +277,27 @@ class Room(Base):
 	@property
 	def user_info_list(self):
 		"""Generator that lists user info dicts for each user in the room."""
-		for username in self.users:
-			if username.startswith("Guest "):
-				yield guest_info_dict(username, self)
+		return self.user_infos(list(self.users))
+
+	def user_infos(self, usernames):
+		"""
+		Generator that lists user info dicts for each of the given usernames.
+		All of the registered users are loaded in a single query, and admin and owner checks are done against
+		the room's cached state, so this costs at most one query no matter how many users there are.
+		"""
+		state = self.state
+
+		registered = [username for username in usernames if not username.startswith("Guest ")]
+		users = {}
+		if len(registered) > 0:
+			users = dict((user.name, user) for user in
+				self.dbsession.query(User.id, User.name).filter(User.name.in_(registered)))
 
-			userdata = self.dbsession.query(User).filter_by(name=username).first()
-			if userdata is not None:
-				yield user_info_dict(userdata, self)
+		for username in usernames:
+			if username.startswith("Guest "):
+				yield guest_info_dict(username, state)
+			elif username in users:
+				yield user_info_dict(users[username], state)
 
 	@property
 	def video_is_playing(self):
@@ -205,21 +312,77 @@ class Room(Base):
 		else:
 			return self.playlist[self.playlist_position].video_id
 
+	@property
+	def current_video_duration(self):
+		"""Gets the duration of the currently playing video in seconds. None if nothing is playing"""
+		if not self.video_is_playing:
+			return None
+		return get_entry_info(self.playlist[self.playlist_position])["duration"]
+
+	@property
+	def playlist_infos(self):
+		"""List of entry info dicts for each video in the playlist."""
+		return get_entry_infos(self.playlist)
+
 	@property
 	def dbsession(self):
 		"""Gets the database session that this room is attached to."""
 		return object_session(self)
 
+	@property
+	def state(self):
+		"""Gets the room's cached RoomState."""
+		return get_room_state(self.slug, self.dbsession)
+
+	def playback_dict(self):
+		"""
+		Returns a dict describing the room's current playback state.
+		This is sent along with events that change it so that other workers don't need to query the database.
+		"""
+		return {
+			"is_playing": self.is_playing,
+			"start_timestamp": int(self.start_timestamp),
+			"last_position": self.last_position,
+			"playlist_position": self.playlist_position,
+		}
+
+	def config_dict(self):
+		"""
+		Returns a dict describing the room's settings, owner, and admins.
+		This is sent along with config update events so that other workers don't need to query the database.
+		"""
+		return {
+			"title": self.title,
+			"topic": self.topic,
+			"owner_id": self.owner_id,
+			"admin_ids": [admin.id for admin in self.admins],
+			"is_private": self.is_private,
+			"users_can_pause": self.users_can_pause,
+			"users_can_skip": self.users_can_skip,
+			"users_can_add": self.users_can_add,
+			"users_can_remove": self.users_can_remove,
+			"users_can_move": self.users_can_move,
+		}
+
 	##############
 	# OPERATIONS #
 	##############
 	# Various operations that can be performed on the room.
 
 	def save(self):
-		"""Saves the room to the database."""
+		"""
+		Saves the room to the database.
+		The room's cached state on this worker is updated straight away, rather than waiting for this worker to hear
+		its own event back from redis, so that anything reading the state in the meantime doesn't act on the old
+		playback. The event still gets applied again when it comes back (see synctron.redis_pubsub).
+		"""
 		self.dbsession.add(self)
 		self.dbsession.commit()
 
+		state = cached_room_state(self.slug)
+		if state is not None:
+			state.apply_playback(self.playback_dict())
+
 	#### PLAYBACK OPERATIONS ####
 	# Operations relating to playback of the current video.
 
@@ -251,7 +414,7 @@ class Room(Base):
 		Seeks to a different time in the video.
 		"""
 		# Set last_position to the time we want to seek to and reset the start time.
-		self.start_time = time.time()
+		self.start_timestamp = time.time()
 		self.last_position = int(seek_time)
 		self.save()
 		self.pub_synchronize()
@@ -269,6 +432,10 @@ class Room(Base):
 
 		Returns the new playlist entry.
 		"""
+		# If the index is invalid, error.
+		if index is not None and (type(index) is not int or index < 0):
+			raise Exception("The given index (%s) isn't valid." % index)
+
 		was_ended = not self.video_is_playing
 		video_info = get_video_info(video_id)
 
@@ -276,27 +443,20 @@ class Room(Base):
 			# The video ID is not valid. Raise an error.
 			raise Exception("The given video ID is not valid.")
 
-		entry = PlaylistEntry(video_id, added_by)
+		entry = PlaylistEntry(video_id, added_by, video_info)
 
-		if index is None:
-			self.playlist.append(entry)
-		else:
-			# If the index is invalid, error.
-			if type(index) is not int:
-				raise Exception("The given index (%s) isn't valid." % index)
+		if index is None or index > len(self.playlist):
+			index = len(self.playlist)
+		elif index < self.playlist_position or (index == self.playlist_position and self.video_is_playing):
+			self.playlist_position += 1
 
-			if index > len(self.playlist):
-				self.playlist.append(entry)
-			else:
-				self.playlist.insert(index, entry)
-				if index < self.playlist_position or (index == self.playlist_position and self.video_is_playing):
-					self.playlist_position += 1
+		self.insert_entries(index, [entry])
 
 		# Add it to the database.
 		self.dbsession.add(entry)
 		self.save()
 
-		self.pub_plist_add(get_entry_info(entry), entry.position)
+		self.pub_plist_add(get_entry_info(entry), index)
 
 		# If the playlist had ended before we added the video, play the one we just added.
 		if was_ended:
@@ -304,6 +464,58 @@ class Room(Base):
 
 		return entry
 
+	def add_videos(self, video_ids, index=None, added_by=None):
+		"""
+		Adds a list of videos to the playlist in one transaction.
+
+		The videos are added in order, starting at the given index. If index is None or greater than the
+		playlist length, they're added to the end of the list.
+		Video IDs that aren't valid are skipped.
+
+		Returns a list of the new playlist entries.
+		"""
+		if index is not None and (type(index) is not int or index < 0):
+			raise Exception("The given index (%s) isn't valid." % index)
+
+		was_ended = not self.video_is_playing
+		video_infos = get_video_infos(video_ids)
+
+		entries = [PlaylistEntry(video_id, added_by, video_infos[video_id])
+			for video_id in video_ids if video_infos[video_id] is not None]
+		if len(entries) == 0:
+			return entries
+
+		if index is None or index > len(self.playlist):
+			index = len(self.playlist)
+		elif index < self.playlist_position or (index == self.playlist_position and self.video_is_playing):
+			self.playlist_position += len(entries)
+
+		self.insert_entries(index, entries)
+
+		# Add them to the database.
+		self.dbsession.add_all(entries)
+		self.save()
+
+		self.pub_plist_add_many(get_entry_infos(entries), index)
+
+		# If the playlist had ended before we added the videos, play the first one we just added.
+		if was_ended:
+			self.change_video(index)
+
+		return entries
+
+	def import_playlist(self, playlist_id, index=None, added_by=None):
+		"""
+		Adds the videos in the given YouTube playlist to the playlist (see add_videos).
+		At most BULK_ADD_LIMIT videos are added.
+
+		Returns a list of the new playlist entries, or None if the YouTube playlist doesn't exist.
+		"""
+		video_ids = get_playlist_video_ids(playlist_id, BULK_ADD_LIMIT)
+		if video_ids is None:
+			return None
+		return self.add_videos(video_ids, index, added_by)
+
 	def remove_video(self, index):
 		"""
 		Removes the video at the given index from the playlist.
@@ -315,8 +527,8 @@ class Room(Base):
 			# If the video we're removing is before the currently playing one, we'll need to decrement playlist_position by one.
 			before_current = True
 		
-		self.dbsession.delete(self.playlist[index])
-		self.playlist.remove(self.playlist[index])
+		# Removing an entry leaves a bigger gap between its neighbours, so nothing else needs to change.
+		self.dbsession.delete(self.playlist.pop(index))
 		self.save()
 
 		self.pub_plist_remove([index])
@@ -325,6 +537,32 @@ class Room(Base):
 		if not before_current and index == self.playlist_position:
 			self.change_video(self.playlist_position)
 
+	def move_video(self, old_index, new_index):
+		"""
+		Moves the video at old_index in the playlist to new_index.
+		Only the moved entry's position changes, unless the playlist needs rebalancing.
+		"""
+		if type(old_index) is not int or old_index < 0 or old_index >= len(self.playlist):
+			raise Exception("The given index (%s) isn't valid." % old_index)
+		if type(new_index) is not int or new_index < 0 or new_index >= len(self.playlist):
+			raise Exception("The given index (%s) isn't valid." % new_index)
+
+		if old_index == new_index:
+			return
+
+		# Keep playlist_position pointing at the same video.
+		if old_index == self.playlist_position:
+			self.playlist_position = new_index
+		elif old_index < self.playlist_position <= new_index:
+			self.playlist_position -= 1
+		elif new_index <= self.playlist_position < old_index:
+			self.playlist_position += 1
+
+		self.insert_entries(new_index, [self.playlist.pop(old_index)])
+		self.save()
+
+		self.pub_plist_move(old_index, new_index)
+
 	def shuffle_playlist(self):
 		"""
 		Shuffles the playlist. Very complicated.
@@ -333,16 +571,50 @@ class Room(Base):
 		if self.video_is_playing:
 			current = self.playlist[self.playlist_position]
 		shuffle(self.playlist)
+		# Every entry moves anyway, so give them all fresh positions.
+		self.rebalance_playlist()
 		if current is not None:
 			self.playlist_position = self.playlist.index(current)
 		self.save()
 		self.pub_plist_update()
 		self.pub_video_changed()
 
-	def change_video(self, index, time_padding=3):
+	def insert_entries(self, index, entries):
+		"""
+		Inserts the given list of entries into the playlist at the given index, in order, and gives them positions.
+		Only the inserted entries' positions are set, unless there's no room for them between their neighbours,
+		in which case the whole playlist is rebalanced.
+		"""
+		for offset, entry in enumerate(entries):
+			self.playlist.insert(index + offset, entry)
+
+		before = self.playlist[index - 1].position if index > 0 else 0
+		if index + len(entries) < len(self.playlist):
+			after = self.playlist[index + len(entries)].position
+		else:
+			after = before + POSITION_GAP * (len(entries) + 1)
+
+		# Spread the new entries evenly across the gap.
+		step = (after - before) // (len(entries) + 1)
+		if step < 1:
+			self.rebalance_playlist()
+			return
+
+		for offset, entry in enumerate(entries):
+			entry.position = before + step * (offset + 1)
+
+	def rebalance_playlist(self):
+		"""
+		Renumbers the positions of every entry in the playlist so that they're POSITION_GAP apart again.
+		"""
+		app.logger.debug("Rebalancing the playlist positions of room %s." % self.slug)
+		for index, entry in enumerate(self.playlist):
+			entry.position = (index + 1) * POSITION_GAP
+
+	def change_video(self, index, time_padding=START_PADDING):
 		"""
 		Changes the current position in the playlist to the given index.
-		time_padding specifies how many seconds of "padding" should be added (defaults to 3 seconds).
+		time_padding specifies how many seconds of "padding" should be added (defaults to START_PADDING).
 		Time padding here is meant to prevent the case where the client syncs a few seconds after the
 		server starts "playing" the video, causing the video to start a few seconds after the actual
 		beginning of the video. This is prevented by setting the server's last_position to 
@@ -359,31 +631,42 @@ class Room(Base):
 
 	def check_video_ended(self):
 		"""
-		Called every few seconds if the video in the room is playing.
-		Checks if the video has ended and calls video_ended if so.
+		Called by the scheduler when the video in the room should have ended.
+		Checks if the video has ended and, if so, changes to the video that should be playing now, at the point it
+		should be at. Normally that's the start of the next video, but nobody may have been watching the room for a
+		while, so more than one video may have ended since.
+		Returns True if the video had ended.
 		"""
 		if self.current_video_id is None:
-			return
+			return False
 			
-		current_video = get_video_info(self.current_video_id)
-		if current_video is None:
-			return
-
-		# Get the duration of the currently playing video.
-		# We add 2 to this to give an extra couple seconds of "padding" to make sure videos
-		# don't seem to end early.
-		duration = current_video["duration"] + 2
-
-		# If the current position is greater than or equal to the duration of the video, the video has ended.
-		if self.current_position >= duration:
-			self.video_ended()
-
-	def video_ended(self):
-		"""
-		Callback for when the currently playing video has ended.
-		"""
-		# Increment playlist position
-		self.change_video(self.playlist_position + 1)
+		duration = self.current_video_duration
+		if duration is None:
+			return False
+
+		# If the current position is less than the duration of the video (plus a couple seconds of "padding" to make
+		# sure videos don't seem to end early), the video hasn't ended.
+		position = self.current_position
+		if position < duration + END_PADDING:
+			return False
+
+		# Walk through the videos after this one, one at a time, until we find the one that would be playing now.
+		# Normally that's the next one, so only its info is looked at. Each video starts START_PADDING seconds before
+		# its beginning, so that's taken off the position as well.
+		index = self.playlist_position + 1
+		position -= duration + END_PADDING + START_PADDING
+		while index < len(self.playlist):
+			duration = get_entry_info(self.playlist[index])["duration"]
+			if duration is None or position < duration + END_PADDING:
+				break
+			position -= duration + END_PADDING + START_PADDING
+			index += 1
+
+		if index < len(self.playlist):
+			self.change_video(index, time_padding=-position)
+		else:
+			self.change_video(index)
+		return True
 
 
 	#### USER OPERATIONS ####
@@ -394,27 +677,55 @@ class Room(Base):
 		Gets a list of dicts containing info about users in the room and passes it to emit_userlist_update.
 		"""
 		userlist_data = [user for user in self.user_info_list]
-		self.emit_userlist_update(userlist_data)
+		self.state.emit_userlist_update(userlist_data)
 
-	def add_user(self, user):
+	def add_user(self, user, playlist_version=None):
 		"""
 		Adds a user to the room and sends it events to initialize the client.
+		If the client already has a copy of the playlist, playlist_version should be its version. If the
+		change log still covers every change since then, the client is only sent those changes.
 		"""
-		user.playlist_update([get_entry_info(entry) for entry in self.playlist])
-		user.video_changed(self.playlist_position, self.current_video_id)
-		userset_update(red)
-		self.userlist_update()
-		self.pub_ulist_update()
+		# The playlist is sent from the cached state, so that it matches the playlist events this worker sends.
+		state = self.state
+		user.send_playlist(state, playlist_version)
+		user.video_changed(state.playlist_position, state.current_video_id)
+
+		counts = local_user_counts.setdefault(self.slug, {})
+		counts[user.name] = counts.get(user.name, 0) + 1
+		if counts[user.name] == 1:
+			# This is the user's first connection to the room on this worker. Let everyone know they joined.
+			store_join(self.slug, user.name, USERSET_TTL, state.title, state.is_private)
+			self.pub_presence(joined=user.info_dict())
+
+		changed = apply_presence(self.slug, str(workerid), joined=user.name)
+
+		# The new connection gets the whole user list. Everyone else just needs to know that the user joined.
+		user.userlist_update([info for info in self.user_info_list])
+		if changed:
+			self.state.emit_user_joined(user.info_dict(), exclude=user)
 
 	def remove_user(self, user):
 		"""
 		Removes a user from the room and emits a userlist update.
 		"""
-		uset_key = "room:%s:%s" % (self.slug, str(workerid))
-		red.srem(uset_key, user.name)
-		userset_update(red)
-		self.userlist_update()
-		self.pub_ulist_update()
+		counts = local_user_counts.get(self.slug, {})
+		if user.name in counts:
+			counts[user.name] -= 1
+			if counts[user.name] <= 0:
+				# That was the user's last connection to the room on this worker, so they've left.
+				del counts[user.name]
+				if len(counts) == 0:
+					del local_user_counts[self.slug]
+
+				store_leave(self.slug, user.name)
+				self.pub_presence(left=user.name)
+
+				if apply_presence(self.slug, str(workerid), left=user.name):
+					self.state.emit_user_left(user.name)
+
+		# If nobody on this worker is in the room anymore, there's no need to keep its state cached.
+		if connections.room_count(self.slug) == 0:
+			invalidate_room_state(self.slug)
 
 
 	#### CHAT OPERATIONS ####
@@ -429,86 +740,80 @@ class Room(Base):
 			self.pub_chat_message(message, user, action=action)
 
 
-	##########
-	# EVENTS #
-	##########
-	# Code relating to the room's events that are passed to the connected users.
-
-	def emit_synchronize(self, video_time=None, is_playing=None):
-		if video_time is None: video_time = self.current_position
-		if is_playing is None: is_playing = self.is_playing
-		[user.synchronize(video_time, is_playing) for user in self.connected_users]
-
-	def emit_video_changed(self, playlist_position=None, video_id=None):
-		if playlist_position is None: playlist_position = self.playlist_position
-		if video_id is None: video_id = self.current_video_id
-		[user.video_changed(playlist_position, video_id) for user in self.connected_users]
-
-	def emit_playlist_update(self, entries=None):
-		if entries is None: entries = [get_entry_info(entry) for entry in self.playlist]
-		[user.playlist_update(entries) for user in self.connected_users]
-
-	def emit_video_added(self, entry, index):
-		[user.video_added(entry, index) for user in self.connected_users]
-
-	def emit_videos_removed(self, indices):
-		[user.videos_removed(indices) for user in self.connected_users]
-
-	def emit_video_moved(self, old_index, new_index):
-		[user.video_moved(old_index, new_index) for user in self.connected_users]
-
-	def emit_userlist_update(self, userlist):
-		[user.userlist_update(userlist, dbsession=self.dbsession) for user in self.connected_users]
-
-	def emit_chat_message(self, message, from_user, action=False):
-		[user.chat_message(message, from_user, action=action) for user in self.connected_users]
-
-	def emit_status_message(self, message, msgtype):
-		[user.status_message(message, msgtype) for user in self.connected_users]
-
-	def emit_config_update(self):
-		[user.config_update(self) for user in self.connected_users]
-
-
 	####################
 	# PUBLISH MESSAGES #
 	####################
 	# Functions for publishing messages for the other servers over redis.
 
 	def redis_publish(self, event, **kwargs):
-		data = { "room": self.slug, "event": event }
+		# Messages are tagged with the worker that sent them, which presence events need to know.
+		data = { "room": self.slug, "event": event, "worker": str(workerid) }
 		data.update(kwargs)
-		red.publish("rooms", json.dumps(data))
+		red.publish(room_channel(self.slug), json.dumps(data))
+
+	# Each message carries the state that it changes, so the workers receiving it don't need to query the database.
 
 	def pub_synchronize(self):
-		self.redis_publish("sync")
+		self.redis_publish("sync", playback=self.playback_dict())
 
 	def pub_video_changed(self):
-		self.redis_publish("video_changed")
+		self.redis_publish("video_changed", playback=self.playback_dict())
+
+	# Playlist changes bump the playlist's version and get recorded in its change log (see synctron.playlistlog),
+	# so that reconnecting clients can catch up on them.
+
+	def pub_plist_change(self, change_type, logged=True, **kwargs):
+		change = dict(kwargs, change_type=change_type)
+		data = dict(change, room=self.slug, event="playlist_change", playlist_position=self.playlist_position)
+		version = publish_playlist_change(self.slug, room_channel(self.slug), data, change if logged else None)
+
+		# If this worker's state is up to date with every earlier change, apply this one to it now. Its echo from redis
+		# will then be ignored because of its version. If not, the change is applied when it comes back, after the
+		# changes the state is missing.
+		state = cached_room_state(self.slug)
+		if state is not None and state.playlist_version == version - 1:
+			# Imported here because redis_pubsub imports this module.
+			from synctron.redis_pubsub import playlist_change
+			playlist_change(dict(data, version=version), state)
 
 	def pub_plist_update(self):
-		self.redis_publish("playlist_change", change_type="update")
+		# The whole playlist is replaced, so clients can't catch up on this from the change log.
+		self.pub_plist_change("update", logged=False, playlist=self.playlist_infos)
 
 	def pub_plist_add(self, entry, index):
-		self.redis_publish("playlist_change", change_type="add", entry=entry, index=index)
+		self.pub_plist_change("add", entry=entry, index=index)
+
+	def pub_plist_add_many(self, entries, index):
+		self.pub_plist_change("add_many", entries=entries, index=index)
 
 	def pub_plist_remove(self, indices):
-		self.redis_publish("playlist_change", change_type="remove", indices=indices)
+		self.pub_plist_change("remove", indices=indices)
 
 	def pub_plist_move(self, old_index, new_index):
-		self.redis_publish("playlist_change", change_type="move", old_index=old_index, new_index=new_index)
+		self.pub_plist_change("move", old_index=old_index, new_index=new_index)
 
-	def pub_ulist_update(self):
-		self.redis_publish("userlist_update")
+	def pub_presence(self, joined=None, left=None):
+		"""
+		Publishes a presence change. joined should be the user info dict of the user who joined,
+		and left should be the name of the user who left.
+		"""
+		self.redis_publish("presence",
+			joined=joined["username"] if joined is not None else None, joined_info=joined, left=left)
+		red.publish(ROOM_LIST_CHANNEL, self.slug)
 
 	def pub_chat_message(self, message, from_user, action=False):
-		self.redis_publish("chat_message", message_type="chat", user=from_user.name, message=message, action=action)
+		self.redis_publish("chat_message", message_type="chat", user=from_user.info_dict(), message=message, action=action)
 
 	def pub_status_message(self, message, msgtype):
 		self.redis_publish("chat_message", message_type="status", message=message, msgtype=msgtype)
 
 	def pub_config_update(self):
-		self.redis_publish("config_update")
+		config = self.config_dict()
+		# Like save, update this worker's state now instead of waiting for the event to come back.
+		state = cached_room_state(self.slug)
+		if state is not None:
+			state.apply_config(config)
+		self.redis_publish("config_update", config=config)
 
 
 class PlaylistEntry(Base):
@@ -523,7 +828,7 @@ class PlaylistEntry(Base):
 	# The video's YouTube video ID.
 	video_id =	Column(String(15))
 
-	# The position of the video in the room's playlist.
+	# The video's sort key in the room's playlist. This isn't its index (see POSITION_GAP).
 	position =	Column(Integer)
 
 	# The username of the user who added the video.
@@ -532,86 +837,87 @@ class PlaylistEntry(Base):
 	# The ID of the room this entry belongs to.
 	room_id =	Column(Integer, ForeignKey("rooms.id"))
 
-	def __init__(self, vid, by=None):
+	# The video's title, author, and duration in seconds.
+	# These are stored so that the playlist can be shown without looking the videos up on YouTube.
+	# Entries added before these were stored have them set to NULL until they're backfilled.
+	title =		Column(String(255))
+	author =	Column(String(255))
+	duration =	Column(Integer)
+
+	# Playlists are loaded and ordered by room and position (see the sparse_playlist_positions migration).
+	__table_args__ = (
+		Index("ix_playlist_entries_room_position", room_id, position),
+	)
+
+	def __init__(self, vid, by=None, video_info=None):
 		self.video_id = vid
 		self.added_by = by
+		if video_info is not None:
+			self.set_video_info(video_info)
+
+	@property
+	def has_video_info(self):
+		"""True if the entry's video info has been stored."""
+		return self.duration is not None
+
+	def set_video_info(self, video_info):
+		"""
+		Stores the title, author, and duration from the given video info dict (see get_video_info) on the entry.
+		"""
+		self.title = video_info["title"]
+		self.author = video_info["author"]
+		self.duration = int(video_info["duration"])
+
+	def info_dict(self):
+		"""
+		Returns a dict containing the entry's stored video info and the user who added it.
+		"""
+		return {
+			"video_id": self.video_id,
+			"title": self.title,
+			"author": self.author,
+			"duration": self.duration,
+			"added_by": self.added_by,
+		}
 
 
 from gevent import sleep as gevent_sleep
 
 def userset_greenlet():
 	"""
-	Greenlet that polls redis for changes in the user sets of each room.
-	This is done by calling the userset update function every few seconds.
+	Greenlet that reconciles this worker's user sets with redis.
+	User sets are normally kept up to date by presence events. This is only a fallback that renews the TTLs on
+	this worker's user sets and catches any changes that were missed, such as workers dying.
 	"""
 	while True:
-		gevent_sleep(5)
+		gevent_sleep(USERSET_RECONCILE_INTERVAL)
 		try:
-			local_red = StrictRedis.from_url(app.config.get("REDIS_URL"))
-			userset_update(local_red)
+			userset_update()
 		except:
 			app.logger.error("Exception in user set polling greenlet.", exc_info=True)
 
-def userset_update(red):
-	global userset_dict
-	uset_hash_key = "worker:" + str(workerid)
-	uset_hash = red.hgetall(uset_hash_key)
-
-	# Renew the TTL for this worker's user set hash.
-	red.expire(uset_hash_key, 30)
-
-	# Once the user set hash's TTL has been renewed, we update our user set.
-	temp_uset_dict = {}
-	for user in connections:
-		if "room" in user.session:
-			room_slug = user.session["room"]
-			if room_slug not in temp_uset_dict:
-				temp_uset_dict[room_slug] = set()
-			temp_uset_dict[room_slug].add(user.name)
-
-	for room_slug, uset in temp_uset_dict.iteritems():
-		# Add the user to the user list on redis.
-		# First, add the user to this room's user set for the current worker.
-		uset_key = "room:%s:%s" % (room_slug, str(workerid))
-		red.delete(uset_key)
-		[red.sadd(uset_key, user) for user in uset]
-
-		# Next, add that user set's key to the room's user set list.
-		red.sadd("room:%s" % room_slug, uset_key)
-
-		# Also make sure the room's slug is in the rooms set.
-		red.sadd("rooms", room_slug)
-
-		# And finally, add the user set's key to the worker's user set list.
-		red.hset("worker:%s" % str(workerid), room_slug, uset_key)
-
-		# Also, make sure we set expire times.
-		red.expire(uset_key, 30)
-
-
-	# Now, we check for changes to the user sets.
-	rooms_set = red.smembers("rooms")
-
-	# First, we find and update the user sets that have changed.
-	# While we do this, we also add anything to our local rooms dict that isn't already in it.
-	lists_changed = []
-	for room_slug in rooms_set:
-		uset_list = red.smembers("room:%s" % room_slug)
-		local_set = userset_dict[room_slug] if room_slug in userset_dict else set()
-		remote_set = red.sunion(uset_list) if len(uset_list) > 0 else set()
-		if local_set != remote_set:
-			if room_slug in userset_dict: del userset_dict[room_slug]
-			userset_dict[room_slug] = remote_set
-			lists_changed.append(room_slug)
-		for uset in uset_list:
-			if red.scard(uset) <= 0:
-				red.srem("room:%s" % room_slug, uset)
-
-	# Rooms in the local rooms dict that are no longer in the rooms hash.
-	rooms_removed = set(userset_dict.keys()) - rooms_set
-	for room_slug in rooms_removed:
-		del userset_dict[room_slug]
-		lists_changed.append(room_slug)
+def userset_update():
+	"""
+	Writes this worker's user sets to redis, then re-reads every worker's user sets and sends user list updates
+	for any rooms whose user sets have changed.
+	"""
+	round_trips = presence_stats["round_trips"]
+	write_worker_sets(local_user_counts, USERSET_TTL)
+	new_worker_usersets = read_user_sets(local_user_counts.keys())
+	app.logger.debug("User set reconciliation took %i redis round trips." % (presence_stats["round_trips"] - round_trips))
+
+	# This worker's own user sets come from local_user_counts, since that's always up to date.
+	for room_slug, wsets in new_worker_usersets.iteritems():
+		wsets.pop(str(workerid), None)
+	for room_slug, counts in local_user_counts.iteritems():
+		new_worker_usersets.setdefault(room_slug, {})[str(workerid)] = set(counts.keys())
+
+	# Find the rooms whose user sets have changed.
+	changed_slugs = set(worker_usersets.keys()) | set(new_worker_usersets.keys())
+	worker_usersets.clear()
+	worker_usersets.update(new_worker_usersets)
+	lists_changed = [room_slug for room_slug in changed_slugs
+		if update_room_userset(room_slug) and room_slug in local_user_counts]
 
 	dbsession = db.Session(db.engine)
 	try:
@@ -20,11 +20,26 @@
 
 from socketio.namespace import BaseNamespace
 
-from synctron import app, db, red
+from synctron import app
 
-from synctron.room import Room
+from synctron.presence import read_top_rooms
+from synctron.packets import encode_event, send_encoded
 
-_connections = []
+from gevent import spawn, sleep as gevent_sleep
+from gevent.event import Event
+
+import time
+
+_connections = set()
+
+# Minimum number of seconds between re-computations of the room list.
+ROOM_LIST_INTERVAL = 1
+
+# Set when the room list needs to be re-computed and sent out.
+_room_list_dirty = Event()
+
+# The most recently computed room list packet and the time it was computed.
+_room_list_cache = { "data": None, "time": 0 }
 
 class RoomListNamespace(BaseNamespace):
 	"""
@@ -33,7 +48,7 @@ class RoomListNamespace(BaseNamespace):
 
 	def initialize(self):
 		self.logger = app.logger
-		_connections.append(self)
+		_connections.add(self)
 
 	def log(self, msg):
 		self.logger.info("[{0}] {1}".format(self.socket.sessid, msg))
@@ -42,8 +57,7 @@ class RoomListNamespace(BaseNamespace):
 		if "silent" in kwargs:
 			del kwargs["silent"]
 
-		if self in _connections:
-			_connections.remove(self)
+		_connections.discard(self)
 		BaseNamespace.disconnect(self, *args, **kwargs)
 
 
@@ -56,39 +70,52 @@ class RoomListNamespace(BaseNamespace):
 		# Send the users room list.
 		self.send_room_user_list_update()
 
-	def send_room_user_list_update(self, broadcast=False):
+	def send_room_user_list_update(self):
 		"""Sends the client a list of rooms with the most users."""
-		room_dict = {}
-		for room_slug in red.smembers("rooms"):
-			userset = set()
-			usetlist = red.smembers("room:%s" % room_slug)
-			if len(usetlist) > 0:
-				userset = red.sunion(usetlist)
-			room_dict[room_slug] = len(userset)
-
-		room_list = []
-		dbsession = db.Session(db.engine)
-		try:
-			for slug, usercount in room_dict.iteritems():
-				if usercount <= 0:
-					continue
-					
-				room = dbsession.query(Room).filter_by(slug=slug).first()
-				if room is None or room.is_private:
-					continue
-
-				room_data = {
-					"slug": slug,
-					"title": room.title,
-					"usercount": usercount,
-				}
-				room_list.append(room_data)
-		finally:
-			dbsession.close()
-
-		room_list.sort(key=lambda room: room["usercount"], reverse=True)
-		self.emit("room_list_users", room_list[:10])
+		data = _room_list_cache["data"]
+		if data is None or time.time() - _room_list_cache["time"] >= ROOM_LIST_INTERVAL:
+			data = encode_room_list()
+		send_encoded([self], data)
+
+
+def encode_room_list():
+	"""
+	Computes the list of rooms with the most users and encodes it as a room_list_users packet.
+	The packet is cached so that it can be re-used by clients that request the list soon after.
+	"""
+	room_list = [{
+			"slug": slug,
+			"title": title,
+			"usercount": usercount,
+		} for slug, title, usercount in read_top_rooms(10)]
+	data = encode_event("/roomlist", "room_list_users", room_list)
+	_room_list_cache["data"] = data
+	_room_list_cache["time"] = time.time()
+	return data
 
 def broadcast_room_user_list_update():
-	"""Calls send_room_user_list_update for all connections."""
-	[connection.send_room_user_list_update() for connection in _connections]
+	"""
+	Marks the room list as changed so that it will be sent to all connections.
+	Any number of calls within ROOM_LIST_INTERVAL seconds result in a single re-computation.
+	"""
+	_room_list_dirty.set()
+
+def room_list_loop():
+	"""
+	Greenlet that re-computes the room list when it changes and sends it to all connections.
+	"""
+	while True:
+		_room_list_dirty.wait()
+		_room_list_dirty.clear()
+		try:
+			if len(_connections) > 0:
+				send_encoded(list(_connections), encode_room_list())
+		except:
+			app.logger.error("Exception broadcasting room list.", exc_info=True)
+		gevent_sleep(ROOM_LIST_INTERVAL)
+
+def start_room_list():
+	"""
+	Starts the room list greenlet.
+	"""
+	spawn(room_list_loop)
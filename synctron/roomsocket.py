@@ -23,11 +23,15 @@ from socketio.namespace import BaseNamespace
 
 from synctron import app, db, connections
 
-from synctron.room import Room, get_entry_info
+from synctron.room import Room, BULK_ADD_LIMIT
+from synctron.roomstate import get_room_state
 from synctron.user import User
 from synctron.vidinfo import get_video_info
+from synctron.playlistlog import read_playlist_changes
+from synctron.packets import send_encoded
 
 from roomlistsocket import broadcast_room_user_list_update
+from synctron.redis_pubsub import watch_room, unwatch_room
 
 # Global variable for counting guests.
 guest_ctr = 1
@@ -74,14 +78,12 @@ class RoomNamespace(BaseNamespace):
 	def initialize(self):
 		self.logger = app.logger
 		self.log("Socket.IO session started.")
-		connections.append(self)
 
 	def log(self, msg):
 		self.logger.info("[{0}] {1}".format(self.socket.sessid, msg))
 
 	def disconnect(self, *args, **kwargs):
-		if self in connections:
-			connections.remove(self)
+		connections.remove(self)
 
 		if "dbsession" in self.session and self.session["dbsession"] is not None:
 			self.log("Closing leaked session")
@@ -96,6 +98,7 @@ class RoomNamespace(BaseNamespace):
 			try:
 				room = self.get_room()
 				room.remove_user(self)
+				unwatch_room(room.slug)
 			finally:
 				dbsession.close()
 
@@ -107,10 +110,11 @@ class RoomNamespace(BaseNamespace):
 
 	@socketevent
 	@dbaccess
-	def on_join(self, room_slug):
+	def on_join(self, room_slug, playlist_version=None):
 		"""
 		Event called by the client when it initially joins a room.
 		room_slug is the slug of the room that the client is joining.
+		playlist_version is the version of the playlist that the client already has, if it's reconnecting.
 
 		This function needs to do the following:
 			- Check if the user is logged in and get their account from the database.
@@ -134,6 +138,9 @@ class RoomNamespace(BaseNamespace):
 		if user is not None:
 			# If the user is logged in, store their user ID in the socket's session dict.
 			self.session["user_id"] = fsession["user"] # So much shit named session...
+			self.session["name"] = user.name
+		else:
+			self.session["name"] = "Guest %i" % self.session["guest_id"]
 
 		# Get the room.
 		room = self.dbsession.query(Room).filter_by(slug=room_slug).first()
@@ -144,8 +151,14 @@ class RoomNamespace(BaseNamespace):
 			return
 
 		self.session["room"] = room_slug
-		self.config_update(room)
-		room.add_user(self)
+		connections.set_room(self, room_slug)
+		# Start listening for the room's events before its state is loaded, so no changes get missed in between.
+		watch_room(room)
+		self.config_update(get_room_state(room_slug, self.dbsession))
+		self.identity()
+		if type(playlist_version) is not int:
+			playlist_version = None
+		room.add_user(self, playlist_version)
 
 	@socketevent
 	@dbaccess
@@ -153,8 +166,8 @@ class RoomNamespace(BaseNamespace):
 		"""
 		Event called by the client to request a re-sync.
 		"""
-		room = self.get_room()
-		self.synchronize(room.current_position, room.is_playing)
+		state = self.get_room_state()
+		self.synchronize(state.current_position, state.is_playing)
 
 	@socketevent
 	@dbaccess
@@ -162,13 +175,13 @@ class RoomNamespace(BaseNamespace):
 		"""
 		Event called by the client to play the video.
 		"""
-		room = self.get_room()
-		if room.is_playing or not self.can_pause:
+		state = self.get_room_state()
+		if state.is_playing or not self.can_pause:
 			# If the room is already playing, re-sync whoever tried to play it.
-			self.synchronize(room.current_position, room.is_playing)
+			self.synchronize(state.current_position, state.is_playing)
 		else:
 			# Otherwise, play the video.
-			room.play()
+			self.get_room().play()
 
 	@socketevent
 	@dbaccess
@@ -176,13 +189,13 @@ class RoomNamespace(BaseNamespace):
 		"""
 		Event called by the client to pause the video.
 		"""
-		room = self.get_room()
-		if not room.is_playing or not self.can_pause:
+		state = self.get_room_state()
+		if not state.is_playing or not self.can_pause:
 			# If the room is already paused, re-sync whoever tried to pause it.
-			self.synchronize(room.current_position, room.is_playing)
+			self.synchronize(state.current_position, state.is_playing)
 		else:
 			# Otherwise, pause the video.
-			room.pause()
+			self.get_room().pause()
 
 	@socketevent
 	@dbaccess
@@ -190,11 +203,11 @@ class RoomNamespace(BaseNamespace):
 		"""
 		Event called by the client to seek to a different point in the video.
 		"""
-		room = self.get_room()
 		if not self.can_pause:
-			self.synchronize(room.current_position, room.is_playing)
+			state = self.get_room_state()
+			self.synchronize(state.current_position, state.is_playing)
 		else:
-			room.seek(seek_time)
+			self.get_room().seek(seek_time)
 
 
 	@socketevent
@@ -224,6 +237,30 @@ class RoomNamespace(BaseNamespace):
 		else:
 			self.emit("error_occurred", "not_allowed", "You're not allowed to add videos to this room.")
 
+	@socketevent
+	@dbaccess
+	def on_add_videos(self, videos, index=None):
+		"""
+		Event called by the client to add several videos to the playlist at once.
+		videos is either a list of video IDs or the ID of a YouTube playlist to import.
+		"""
+		if self.can_add:
+			room = self.get_room()
+			if isinstance(videos, basestring):
+				entries = room.import_playlist(videos, index, self.name)
+				if entries is None:
+					self.emit("error_occurred", "invalid_playlist", "The given playlist ID is not valid.")
+			elif isinstance(videos, list):
+				video_ids = [video_id for video_id in videos[:BULK_ADD_LIMIT] if isinstance(video_id, basestring)]
+				entries = room.add_videos(video_ids, index, self.name)
+				if len(entries) < len(video_ids):
+					self.emit("error_occurred", "invalid_vid",
+						"%d of the given video IDs are not valid." % (len(video_ids) - len(entries)))
+			else:
+				self.emit("error_occurred", "invalid_vid", "Expected a list of video IDs or a playlist ID.")
+		else:
+			self.emit("error_occurred", "not_allowed", "You're not allowed to add videos to this room.")
+
 	@socketevent
 	@dbaccess
 	def on_remove_video(self, index):
@@ -242,8 +279,33 @@ class RoomNamespace(BaseNamespace):
 		"""
 		Event called by the client to reload the playlist.
 		"""
-		room = self.get_room()
-		self.playlist_update([get_entry_info(entry) for entry in room.playlist])
+		self.send_playlist(self.get_room_state())
+
+	@socketevent
+	@dbaccess
+	def on_playlist_range(self, start, count):
+		"""
+		Event called by the client to load the part of the playlist starting at index start.
+		At most PLAYLIST_RANGE_LIMIT entries are sent.
+		"""
+		if type(start) is not int or type(count) is not int or start < 0 or count < 0:
+			self.emit("error_occurred", "invalid_range", "The given playlist range is not valid.")
+			return
+
+		state = self.get_room_state()
+		self.playlist_range(start, state.playlist_range(start, count), state.playlist_summary(), state.playlist_version)
+
+	@socketevent
+	@dbaccess
+	def on_move_video(self, old_index, new_index):
+		"""
+		Event called by the client to move a video to a different index in the playlist.
+		"""
+		if self.can_move:
+			room = self.get_room()
+			room.move_video(old_index, new_index)
+		else:
+			self.emit("error_occurred", "not_allowed", "You're not allowed to move videos in this room.")
 
 	@socketevent
 	@dbaccess
@@ -280,7 +342,7 @@ class RoomNamespace(BaseNamespace):
 			return
 
 		room = self.get_room()
-		for user in room.users:
+		for user in connections.in_room(room.slug):
 			if user.name == username:
 				# Kick the user.
 				room.pub_status_message("%s kicked %s from the room. Reason: %s" % (self.name, user.name, message), "Status")
@@ -300,52 +362,25 @@ class RoomNamespace(BaseNamespace):
 			return None
 
 	@property
-	@dbaccess
 	def name(self):
-		"""The user's name."""
-		user = None
-		if not self.is_guest:
-			user = self.dbsession.query(User).filter_by(id=self.user_id).first()
-		if user is None:
-			return "Guest %i" % self.session["guest_id"]
-		else:
-			return user.name
+		"""The user's name. This is resolved when the user joins a room."""
+		return self.session.get("name")
 
 	@property
-	@dbaccess
 	def is_owner(self):
 		"""True if this user owns the room it's connected to."""
-		if self.is_guest:
-			return False
-		else:
-			room = self.get_room()
-			if room.owner is None:
-				return False
-			else:
-				return room.owner.id == self.user_id
+		return self.permissions.get("is_owner", False)
 
 	@property
-	@dbaccess
 	def is_admin(self):
 		"""True if this user is an admin in the room it's connected to."""
-		if self.is_guest:
-			return False
-		elif self.is_owner:
-			return True
-		else:
-			room = self.get_room()
-			for admin in room.admins:
-				if admin.id == self.user_id:
-					return True
-			return False
+		return self.permissions.get("is_admin", False)
 
 	@property
-	@dbaccess
 	def is_guest(self):
 		"""True if this user is a guest."""
 		return self.user_id is None
 
-	@dbaccess
 	def info_dict(self):
 		"""
 		A dict containing some information about this user that is used by the user list.
@@ -367,62 +402,74 @@ class RoomNamespace(BaseNamespace):
 		else:
 			return None
 
+	@dbaccess
+	def get_room_state(self):
+		"""
+		Gets the cached state of the user's current room.
+		The state is only loaded from the database if it isn't already cached on this worker.
+		"""
+		if "room" in self.session:
+			return get_room_state(self.session["room"], self.dbsession)
+		else:
+			return None
+
 	@property
 	def dbsession(self):
 		return self.session["dbsession"]
 
+	@property
+	def permissions(self):
+		"""
+		Dict containing this user's permissions in the room it's connected to.
+		Set by update_permissions.
+		"""
+		return self.session.get("permissions", {})
+
+	def update_permissions(self, state):
+		"""
+		Resolves this user's permissions from the given room state and stores them in the socket's session.
+		This is done when the user joins and when the room's settings or admins change, so that checking
+		permissions doesn't require any database access.
+		"""
+		is_owner = not self.is_guest and state.owner_id == self.user_id
+		is_admin = state.is_admin(self.user_id)
+		self.session["permissions"] = {
+			"is_owner": is_owner,
+			"is_admin": is_admin,
+			"can_pause": is_admin or state.users_can_pause,
+			"can_skip": is_admin or state.users_can_skip,
+			"can_add": is_admin or state.users_can_add,
+			"can_remove": is_admin or state.users_can_remove,
+			"can_move": is_admin or state.users_can_move,
+		}
+
 
 	## Permissions ##
 
 	@property
-	@dbaccess
 	def can_pause(self):
 		"""True if the user is allowed to play/pause the video in the room."""
-		if self.is_admin:
-			return True
-		else:
-			room = self.get_room()
-			return room.users_can_pause
+		return self.permissions.get("can_pause", False)
 
 	@property
-	@dbaccess
 	def can_skip(self):
 		"""True if the user is allowed to change the playing video in the room."""
-		if self.is_admin:
-			return True
-		else:
-			room = self.get_room()
-			return room.users_can_skip
+		return self.permissions.get("can_skip", False)
 
 	@property
-	@dbaccess
 	def can_add(self):
 		"""True if the user is allowed to add videos to the room."""
-		if self.is_admin:
-			return True
-		else:
-			room = self.get_room()
-			return room.users_can_add
+		return self.permissions.get("can_add", False)
 
 	@property
-	@dbaccess
 	def can_remove(self):
 		"""True if the user is allowed to remove videos from the room."""
-		if self.is_admin:
-			return True
-		else:
-			room = self.get_room()
-			return room.users_can_remove
+		return self.permissions.get("can_remove", False)
 
 	@property
-	@dbaccess
 	def can_move(self):
 		"""True if the user can move videos in the playlist."""
-		if self.is_admin:
-			return True
-		else:
-			room = self.get_room()
-			return room.users_can_move
+		return self.permissions.get("can_move", False)
 
 
 	###############
@@ -442,53 +489,48 @@ class RoomNamespace(BaseNamespace):
 		"""
 		self.emit("video_changed", playlist_position, video_id)
 
-	def playlist_update(self, entries):
-		"""
-		Event fired to send the user the entire playlist.
-		entries is an array containing information about the videos.
-		"""
-		self.emit("playlist_update", entries)
+	# The playlist events all end with the version of the playlist after the change.
 
-	def video_added(self, entry, index):
+	def playlist_range(self, start, entries, summary, version):
 		"""
-		Event fired when videos are added to the playlist.
-		entry is an array containing information about the video.
-		index is the index of the added video.
+		Event fired to send the user the part of the playlist that it asked for.
+		entries is an array containing information about the videos, starting at index start.
 		"""
-		self.emit("video_added", entry, index)
+		self.emit("playlist_range", start, entries, summary, version)
 
-	def videos_removed(self, indices):
+	def playlist_changes(self, changes, version):
 		"""
-		Event fired when a video is removed from the playlist.
-		indices is an array of the indices of the videos that were removed.
+		Event fired to catch the user's copy of the playlist up with the changes it missed.
+		changes is an array of playlist change dicts, oldest first.
 		"""
-		self.emit("videos_removed", indices)
+		self.emit("playlist_changes", changes, version)
 
-	def video_moved(self, old_index, new_index):
+	def send_playlist(self, state, since_version=None):
 		"""
-		Event fired when a video is moved to a new index in the playlist.
-		old_index is the video's old index.
-		new_index is the video's new index.
+		Sends the user the playlist in the given room state.
+		If since_version is given and the change log covers every change since then, only those changes are sent.
 		"""
-		self.emit("video_moved", old_index, new_index)
+		changes = None
+		if since_version is not None:
+			changes = read_playlist_changes(state.slug, since_version, state.playlist_version)
+
+		if changes is None:
+			send_encoded([self], state.playlist_snapshot(self.ns_name))
+		else:
+			self.playlist_changes(changes, state.playlist_version)
 
-	@dbaccess
 	def userlist_update(self, userlist):
 		"""
 		Sends the userlist to the client.
 		"""
-		self.emit("userlist_update", 
-			[dict(
-				userinfo, 
-				isyou=userinfo["username"] == self.name) 
-			for userinfo in userlist])
+		self.emit("userlist_update", userlist)
 
-	def chat_message(self, message, from_user, action=False):
+	def identity(self):
 		"""
-		Event fired when a chat message is sent out.
-		If action is True, the message will be an action (/me).
+		Sends the client its own user info dict.
+		The client uses this to figure out which entry in the user list is itself.
 		"""
-		self.emit("chat_message", message, from_user["username"], action)
+		self.emit("identity", self.info_dict())
 
 	def status_message(self, message, msgtype):
 		"""
@@ -497,19 +539,13 @@ class RoomNamespace(BaseNamespace):
 		"""
 		self.emit("status_message", message, msgtype)
 
-	def config_update(self, room):
+	def config_update(self, state):
 		"""
 		Event fired when room settings change.
+		Also re-resolves the user's permissions, since those depend on the room's settings and admins.
 		"""
-		self.emit("config_update", {
-			"title": room.title,
-			"topic": room.topic,
-			"users_can_add": room.users_can_add,
-			"users_can_remove": room.users_can_remove,
-			"users_can_move": room.users_can_move,
-			"users_can_pause": room.users_can_pause,
-			"users_can_skip": room.users_can_skip,
-		})
+		self.update_permissions(state)
+		self.emit("config_update", state.config_event_dict())
 
 	def kick(self, by, message):
 		"""
@@ -0,0 +1,344 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+A worker-local cache of room state.
+
+Socket events need to know things like whether a room is playing and who its admins are
+far more often than that information actually changes. Rather than query the database
+for every event, each worker keeps a RoomState for the rooms it's using. The events that
+rooms publish over redis carry the state they change, so the cached states are updated
+straight from those events without going back to the database.
+
+RoomState is also what sends events to the users connected to a room on this worker.
+"""
+
+from synctron import app, db, connections
+from synctron.packets import encode_event, send_encoded
+from synctron.playlistlog import read_playlist_version
+
+import time
+
+# Number of playlist entries that are sent to clients along with the playlist summary.
+# Clients request the rest of the playlist in windows of up to PLAYLIST_RANGE_LIMIT entries as they need them.
+PLAYLIST_WINDOW = app.config.get("PLAYLIST_WINDOW", 50)
+PLAYLIST_RANGE_LIMIT = app.config.get("PLAYLIST_RANGE_LIMIT", 100)
+
+# Dict mapping room slugs to their cached RoomState objects.
+_room_states = {}
+
+# Counters for cache hits and misses. The snapshot counters are for the playlist snapshots cached in each state.
+cache_stats = { "hits": 0, "misses": 0, "invalidations": 0, "snapshot_hits": 0, "snapshot_misses": 0 }
+
+class RoomState(object):
+	"""
+	A snapshot of a room's playback state, settings, admin list, and playlist.
+	"""
+
+	def __init__(self, room):
+		"""
+		Initializes the room state from the given Room database object.
+		"""
+		self.id = room.id
+		self.slug = room.slug
+		self.apply_config(room.config_dict())
+		self.apply_playback(room.playback_dict())
+
+		# List of entry info dicts for each entry in the playlist, and the version of the playlist
+		# (see synctron.playlistlog).
+		self.playlist, self.playlist_version = load_playlist(room)
+
+		self.invalidate_playlist_snapshot()
+
+	def apply_config(self, config):
+		"""
+		Updates the room's settings, owner, and admins from the given dict (see Room.config_dict).
+		"""
+		self.title = config["title"]
+		self.topic = config["topic"]
+
+		self.owner_id = config["owner_id"]
+		self.admin_ids = frozenset(config["admin_ids"])
+
+		self.is_private = config["is_private"]
+		self.users_can_pause = config["users_can_pause"]
+		self.users_can_skip = config["users_can_skip"]
+		self.users_can_add = config["users_can_add"]
+		self.users_can_remove = config["users_can_remove"]
+		self.users_can_move = config["users_can_move"]
+
+	def apply_playback(self, playback):
+		"""
+		Updates the room's playback state from the given dict (see Room.playback_dict).
+		"""
+		self.is_playing = playback["is_playing"]
+		self.start_timestamp = playback["start_timestamp"]
+		self.last_position = playback["last_position"]
+		self.playlist_position = playback["playlist_position"]
+
+	@property
+	def connected_users(self):
+		"""List of users connected to this room on this worker."""
+		return connections.in_room(self.slug)
+
+	def playlist_range(self, start, count):
+		"""Returns a list of entry info dicts for up to count videos in the playlist, starting at index start."""
+		return self.playlist[start:start + min(count, PLAYLIST_RANGE_LIMIT)]
+
+	def playlist_window(self):
+		"""
+		Returns a (start, entries) tuple containing the window of the playlist that's sent to clients when they
+		load the playlist. The window starts a little before the current video, so clients can see what just played.
+		"""
+		start = max(0, min(self.playlist_position - PLAYLIST_WINDOW // 5, len(self.playlist) - PLAYLIST_WINDOW))
+		return start, self.playlist[start:start + PLAYLIST_WINDOW]
+
+	def playlist_summary(self):
+		"""Returns a dict containing the number of videos in the playlist and their total duration."""
+		if self._summary is None:
+			self._summary = {
+				"count": len(self.playlist),
+				"duration": sum(entry["duration"] or 0 for entry in self.playlist),
+			}
+		return self._summary
+
+	def playlist_snapshot(self, endpoint):
+		"""
+		Returns the encoded playlist_update packet for the given namespace endpoint, which contains the playlist's
+		window and summary. The packet is cached, so sending the playlist to joining users costs almost nothing
+		until the playlist or the current video changes.
+		"""
+		# The window depends on the current video, so the snapshot has to be rebuilt when that changes too.
+		key = (endpoint, self.playlist_version, self.playlist_position)
+		if self._snapshot is not None and self._snapshot[0] == key:
+			cache_stats["snapshot_hits"] += 1
+			return self._snapshot[1]
+
+		cache_stats["snapshot_misses"] += 1
+		start, entries = self.playlist_window()
+		data = encode_event(endpoint, "playlist_update", entries, start, self.playlist_summary(), self.playlist_version)
+		self._snapshot = (key, data)
+		return data
+
+	def reload_playlist(self):
+		"""
+		Re-loads the playlist and its version from the database. This is used when the state has missed a change.
+		"""
+		self.playlist, self.playlist_version = load_playlist(self)
+		self.invalidate_playlist_snapshot()
+
+	def invalidate_playlist_snapshot(self):
+		"""
+		Throws away the cached playlist snapshot and summary. This must be called whenever the playlist changes.
+		"""
+		self._snapshot = None
+		self._summary = None
+
+	@property
+	def current_position(self):
+		"""Calculates what the current time in the video's playback should be."""
+		if self.is_playing:
+			return int(time.time()) - int(self.start_timestamp) + self.last_position
+		else:
+			return self.last_position
+
+	@property
+	def video_is_playing(self):
+		"""Returns true if playlist_position refers to an actual video in the playlist."""
+		return self.playlist_position >= 0 and self.playlist_position < len(self.playlist)
+
+	@property
+	def current_video_id(self):
+		"""Gets the video ID of the currently playing video. None if nothing is playing"""
+		if not self.video_is_playing:
+			return None
+		else:
+			return self.playlist[self.playlist_position]["video_id"]
+
+	@property
+	def current_video_duration(self):
+		"""Gets the duration of the currently playing video in seconds. None if nothing is playing"""
+		if not self.video_is_playing:
+			return None
+		else:
+			return self.playlist[self.playlist_position]["duration"]
+
+	def config_event_dict(self):
+		"""Returns the dict of room settings that's sent to clients with the config_update event."""
+		return {
+			"title": self.title,
+			"topic": self.topic,
+			"users_can_add": self.users_can_add,
+			"users_can_remove": self.users_can_remove,
+			"users_can_move": self.users_can_move,
+			"users_can_pause": self.users_can_pause,
+			"users_can_skip": self.users_can_skip,
+		}
+
+	def is_admin(self, user_id):
+		"""Returns true if the user with the given ID is an admin or the owner of the room."""
+		return user_id is not None and (user_id == self.owner_id or user_id in self.admin_ids)
+
+	##########
+	# EVENTS #
+	##########
+	# Code relating to the room's events that are passed to the connected users.
+
+	# Events that go to everyone in the room are encoded once and the same packet is sent to every connection.
+	# Nothing in them is specific to the user receiving them. Clients work out which user list entry is
+	# their own from the identity event they're sent when they join.
+
+	def broadcast(self, event, *args, **kwargs):
+		"""
+		Sends the given event to every user connected to the room on this worker, encoding it only once.
+		If exclude is given, that connection isn't sent the event.
+		"""
+		exclude = kwargs.pop("exclude", None)
+		users = [user for user in self.connected_users if user is not exclude]
+		if len(users) > 0:
+			send_encoded(users, encode_event(users[0].ns_name, event, *args))
+
+	def emit_synchronize(self, video_time=None, is_playing=None):
+		if video_time is None: video_time = self.current_position
+		if is_playing is None: is_playing = self.is_playing
+		self.broadcast("sync", video_time, is_playing)
+
+	def emit_video_changed(self, playlist_position=None, video_id=None):
+		if playlist_position is None: playlist_position = self.playlist_position
+		if video_id is None: video_id = self.current_video_id
+		self.broadcast("video_changed", playlist_position, video_id)
+
+	# Playlist events carry the playlist's version, so clients know which version they have when they reconnect.
+
+	def emit_playlist_update(self):
+		users = self.connected_users
+		if len(users) > 0:
+			send_encoded(users, self.playlist_snapshot(users[0].ns_name))
+
+	def emit_video_added(self, entry, index):
+		self.broadcast("video_added", entry, index, self.playlist_version)
+
+	def emit_videos_added(self, entries, index):
+		self.broadcast("videos_added", entries, index, self.playlist_version)
+
+	def emit_videos_removed(self, indices):
+		self.broadcast("videos_removed", indices, self.playlist_version)
+
+	def emit_video_moved(self, old_index, new_index):
+		self.broadcast("video_moved", old_index, new_index, self.playlist_version)
+
+	def emit_userlist_update(self, userlist):
+		self.broadcast("userlist_update", userlist)
+
+	def emit_user_joined(self, userinfo, exclude=None):
+		self.broadcast("user_joined", userinfo, exclude=exclude)
+
+	def emit_user_left(self, username, exclude=None):
+		self.broadcast("user_left", username, exclude=exclude)
+
+	def emit_chat_message(self, message, from_user, action=False):
+		self.broadcast("chat_message", message, from_user["username"], action)
+
+	def emit_status_message(self, message, msgtype):
+		self.broadcast("status_message", message, msgtype)
+
+	def emit_config_update(self):
+		# Permissions are resolved separately for each user, but the event itself is the same for everyone.
+		[user.update_permissions(self) for user in self.connected_users]
+		self.broadcast("config_update", self.config_event_dict())
+
+
+def load_playlist(room):
+	"""
+	Loads the given room's playlist from the database along with its version.
+	room can be a Room or a RoomState.
+	Returns a tuple of the list of entry info dicts for each entry in the playlist and the version.
+
+	The version is read before and after the playlist, and if it changed in between, the playlist is loaded again.
+	Otherwise, a change made while the playlist was being loaded could end up either missing from it or applied to it
+	twice. Changes are committed before their version is incremented, so each load is done in a new session, whose
+	transaction can see every change up to the version read before it.
+	"""
+	# Imported here because the room module needs to invalidate states when rooms are saved.
+	from synctron.room import Room
+
+	version = read_playlist_version(room.slug)
+	while True:
+		dbsession = db.Session(db.engine)
+		try:
+			loaded = dbsession.query(Room).get(room.id)
+			playlist = loaded.playlist_infos if loaded is not None else []
+		finally:
+			dbsession.close()
+
+		new_version = read_playlist_version(room.slug)
+		if new_version == version:
+			return playlist, version
+		version = new_version
+
+def get_room_state(slug, dbsession):
+	"""
+	Gets the cached state for the room with the given slug.
+	If the room isn't cached, it's loaded using the given database session.
+	Returns None if the room doesn't exist.
+	"""
+	state = _room_states.get(slug)
+	if state is not None:
+		cache_stats["hits"] += 1
+		return state
+
+	cache_stats["misses"] += 1
+
+	# Imported here because the room module needs to invalidate states when rooms are saved.
+	from synctron.room import Room
+	room = dbsession.query(Room).filter_by(slug=slug).first()
+	if room is None:
+		return None
+	return store_room_state(room)
+
+def cached_room_state(slug):
+	"""
+	Gets the cached state for the room with the given slug, without ever going to the database.
+	Returns None if the room isn't cached.
+	"""
+	return _room_states.get(slug)
+
+def store_room_state(room):
+	"""
+	Builds a new RoomState from the given Room database object and caches it.
+	Returns the new state.
+	"""
+	state = RoomState(room)
+	_room_states[room.slug] = state
+	return state
+
+def invalidate_room_state(slug):
+	"""
+	Removes the given room's state from the cache, forcing it to be re-loaded the next time it's needed.
+	"""
+	if _room_states.pop(slug, None) is not None:
+		cache_stats["invalidations"] += 1
+
+def room_state_stats():
+	"""
+	Returns a dict containing the cache's hit, miss, and invalidation counters, as well as its size.
+	This is logged periodically by synctron.stats.
+	"""
+	return dict(cache_stats, size=len(_room_states))
@@ -0,0 +1,253 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Scheduler for ending videos in rooms.
+
+Rather than polling every playing room every few seconds to see if its video has ended, the
+scheduler keeps a heap of rooms keyed by the time their current video will end and sleeps
+until the earliest one is due. A room's deadline is re-armed whenever its playback state
+changes (the sync, video_changed, and playlist_change events), so rooms that aren't due
+cost nothing.
+
+Each worker arms deadlines for the rooms it's watching (the rooms it has users connected to),
+but only one worker at a time may actually end videos in a given room. Before ending a video, a worker has to hold that room's
+lease in redis. Whenever a worker arms a deadline, it takes the lease if nobody holds it, or renews it if it already
+does, so that it lasts until LEASE_MARGIN seconds after the deadline, and arms the deadline as is. A worker that finds
+the lease held by another worker arms its deadline LEASE_MARGIN seconds late instead, and doesn't try for the lease again
+until the other worker's lease would have run out. Normally the owner ends the video on time and everyone re-arms for
+the next video when they hear about it. If the owner dies, its lease runs out just as the other workers' deadlines fire,
+and one of them takes over.
+"""
+
+from synctron import app, db, red, workerid
+from synctron.room import Room, END_PADDING
+from synctron.channels import is_watching
+
+from gevent import spawn
+from gevent.event import Event
+
+import heapq
+import math
+import time
+
+# How long (in seconds) a room's lease lasts past the deadline it was renewed for. This is also how long the workers
+# that don't hold the lease wait past a deadline before trying to take the room over.
+LEASE_MARGIN = 5
+
+# Heap of (deadline, room_slug) tuples.
+_deadline_heap = []
+
+# Dict mapping room slugs to their current deadline.
+# Entries in the heap whose deadline doesn't match the one in here are stale and are skipped.
+_deadlines = {}
+
+# Event used to wake the scheduler up when a deadline earlier than the one it's waiting on is added.
+_wakeup = Event()
+
+# Dict mapping the slugs of the rooms whose lease this worker holds (or last held) to the time its lease lasts until.
+_leases = {}
+
+# Dict mapping the slugs of rooms whose lease is held by another worker to the time that lease lasted until when we
+# last checked.
+_foreign_leases = {}
+
+# Lua script that acquires or renews a room's lease.
+# KEYS[1] is the lease key, ARGV[1] is this worker's ID, and ARGV[2] is how many seconds the lease should last.
+# Returns 0 if the worker holds the lease. Otherwise, returns the number of seconds left on the other worker's lease.
+_acquire_lease = red.register_script("""
+local owner = redis.call("GET", KEYS[1])
+if not owner or owner == ARGV[1] then
+	redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+	return 0
+end
+return math.max(redis.call("TTL", KEYS[1]), 1)
+""")
+
+# Lua script that releases a room's lease if it's held by the given worker.
+# KEYS[1] is the lease key and ARGV[1] is this worker's ID.
+_release_lease = red.register_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+	redis.call("DEL", KEYS[1])
+end
+""")
+
+def lease_key(slug):
+	"""Returns the key of the given room's lease."""
+	return "lease:room:%s" % slug
+
+def acquire_room_lease(slug, until):
+	"""
+	Tries to acquire (or renew) this worker's lease on the given room, so that it lasts until the given time since epoch.
+	Returns 0 if this worker holds the lease and may end videos in the room. Otherwise, returns the number of seconds
+	until the lease held by the other worker runs out.
+	"""
+	wait = _acquire_lease(keys=[lease_key(slug)], args=[str(workerid), max(int(math.ceil(until - time.time())), 1)])
+	if wait == 0:
+		_leases[slug] = until
+		_foreign_leases.pop(slug, None)
+	else:
+		_leases.pop(slug, None)
+		_foreign_leases[slug] = time.time() + wait
+	return wait
+
+def release_room_lease(slug):
+	"""
+	Gives up this worker's lease on the given room, if it holds it, so another worker can take the room over right away.
+	"""
+	_foreign_leases.pop(slug, None)
+	if _leases.pop(slug, None) is not None:
+		_release_lease(keys=[lease_key(slug)], args=[str(workerid)])
+
+def video_end_time(room):
+	"""
+	Returns the time since epoch at which the given room's current video will have ended.
+	room can be a Room or a RoomState.
+	Returns None if nothing is playing in the room.
+	"""
+	if not room.is_playing or not room.video_is_playing:
+		return None
+
+	duration = room.current_video_duration
+	if duration is None:
+		return None
+
+	# Room.current_position works in whole seconds, so round up to make sure the video has actually
+	# ended by the time the deadline fires.
+	return math.ceil(int(room.start_timestamp) - room.last_position + duration + END_PADDING)
+
+def schedule_room(room, not_before=None):
+	"""
+	Arms (or re-arms) the given room's deadline based on its current playback state.
+	If nothing is playing in the room, its deadline is cancelled.
+	If not_before is given, the deadline won't be earlier than that time.
+	"""
+	deadline = video_end_time(room)
+	if deadline is None:
+		cancel_room(room.slug)
+		return
+
+	if not_before is not None:
+		deadline = max(deadline, not_before)
+
+	# Hold the room's lease until just after the new deadline. If this worker already holds it for long enough, there's
+	# nothing to do. If another worker held it the last time we checked and still will at the deadline, leave the
+	# deadline to that worker and only step in if it doesn't. Otherwise, try to take (or renew) the lease, and only
+	# arm late if another worker turns out to hold it.
+	until = deadline + LEASE_MARGIN
+	if room.slug in _leases:
+		owned = _leases[room.slug] >= until or acquire_room_lease(room.slug, until) == 0
+	elif _foreign_leases.get(room.slug, 0) > deadline:
+		owned = False
+	else:
+		owned = acquire_room_lease(room.slug, until) == 0
+
+	if not owned:
+		deadline += LEASE_MARGIN
+
+	arm_deadline(room.slug, deadline)
+
+def arm_deadline(slug, deadline):
+	"""
+	Sets the given room's deadline to the given time since epoch.
+	"""
+	if _deadlines.get(slug) == deadline:
+		return
+
+	_deadlines[slug] = deadline
+	heapq.heappush(_deadline_heap, (deadline, slug))
+	_wakeup.set()
+
+def cancel_room(slug):
+	"""
+	Cancels the given room's deadline, if it has one.
+	"""
+	_deadlines.pop(slug, None)
+
+def forget_room(slug):
+	"""
+	Cancels the given room's deadline and gives up its lease. This is done when this worker stops watching the room.
+	"""
+	cancel_room(slug)
+	release_room_lease(slug)
+
+def room_due(slug):
+	"""
+	Called when the given room's deadline has passed.
+	Ends the video if the room's state in the database agrees that it's over. Otherwise, the deadline is re-armed.
+	If another worker holds the room's lease, it's left to that worker and we check back when the lease runs out, in
+	case that worker has died. If it hasn't, it'll have ended the video by then and we'll have re-armed for the next one.
+	"""
+	# Hold the lease for long enough to end the video. Ending it arms the next deadline, which renews the lease.
+	wait = acquire_room_lease(slug, time.time() + LEASE_MARGIN)
+	if wait != 0:
+		if is_watching(slug):
+			arm_deadline(slug, time.time() + wait)
+		return
+
+	dbsession = db.Session(db.engine)
+	try:
+		room = dbsession.query(Room).filter_by(slug=slug).first()
+		if room is None:
+			return
+
+		if not room.check_video_ended():
+			# The room's state changed since the deadline was armed. Make sure we don't spin on a deadline
+			# that's already passed.
+			schedule_room(room, not_before=time.time() + 1)
+	finally:
+		dbsession.close()
+
+def scheduler_loop():
+	"""
+	Greenlet that waits for room deadlines and calls room_due when they pass.
+	"""
+	while True:
+		try:
+			# Throw away stale deadlines.
+			while len(_deadline_heap) > 0 and _deadlines.get(_deadline_heap[0][1]) != _deadline_heap[0][0]:
+				heapq.heappop(_deadline_heap)
+
+			timeout = None
+			if len(_deadline_heap) > 0:
+				timeout = _deadline_heap[0][0] - time.time()
+
+			if timeout is None or timeout > 0:
+				# Sleep until the next deadline or until a new one is added.
+				_wakeup.clear()
+				_wakeup.wait(timeout)
+				continue
+
+			deadline, slug = heapq.heappop(_deadline_heap)
+			del _deadlines[slug]
+			try:
+				room_due(slug)
+			except:
+				app.logger.error("Exception ending video in room %s." % slug, exc_info=True)
+		except:
+			app.logger.error("Exception in video end scheduler.", exc_info=True)
+
+def start_scheduler():
+	"""
+	Starts the scheduler greenlet.
+	Rooms are armed as this worker starts watching them, so there's nothing to arm up front. Rooms nobody is watching
+	keep their playback state in the database, and Room.check_video_ended catches them up when they're armed again.
+	"""
+	spawn(scheduler_loop)
@@ -37,7 +37,8 @@ function stuffReady()
 	if (socketReady && iframeApiReady) 
 	{
 		console.log("Joining room...");
-		socket.emit("join", room_slug);
+		// If we're reconnecting, we already have a copy of the playlist, so we only need the changes we missed.
+		socket.emit("join", room_slug, playlistVersion);
 
 		// Start the update state timeout loop.
 		updateStateTimeout();
@@ -100,6 +101,9 @@ function initWebSocket()
 	socket.on("disconnect", function()
 	{
 		console.log("Disconnected from server.");
+
+		// Any part of the playlist we asked for isn't coming. We get sent the playlist again when we re-join.
+		resetPlaylistRequests();
 		if (server_error_msg === undefined)
 		{
 			alertBox("Disconnected from the server.", "error");
@@ -166,6 +170,10 @@ function initWebSocket()
 
 		// Set the current video.
 		changeCurrentIndex(playlist_position);
+
+		// If we haven't loaded the new video's part of the playlist yet, load it.
+		if (playlistObj[playlist_position] === null)
+			requestPlaylistRange(Math.max(0, playlist_position - 10));
 		vplayer.loadVideoById(video_id === undefined || video_id === null ? "" : video_id);
 
 		console.log("Requesting sync...");
@@ -182,65 +190,86 @@ function initWebSocket()
 		updatePlaylistHeight();
 	});
 
-	socket.on("playlist_update", function(entries)
+	socket.on("playlist_update", function(entries, start, summary, version)
 	{
+		// The whole playlist was replaced, so the parts of it we asked for don't line up anymore.
+		resetPlaylistRequests();
+
+		// We only get sent part of the playlist. Everything else stays null until we ask for it.
 		playlistObj = [];
-		entries.forEach(function(video, index)
+		for (var i = 0; i < summary.count; i++)
+			playlistObj.push(null);
+
+		setPlaylistEntries(start, entries);
+		playlistDuration = summary.duration;
+		playlistVersion = version;
+		updatePlaylistElement();
+	});
+
+	socket.on("playlist_range", function(start, entries, summary, version)
+	{
+		rangeRequested = false;
+
+		// If the playlist changed since we asked for this, the indices might not line up anymore.
+		if (version === playlistVersion)
 		{
-			addPlaylistEntry(video, index);
-		});
+			setPlaylistEntries(start, entries);
+			playlistDuration = summary.duration;
+			updatePlaylistElement();
+		}
+
+		// If another part of the playlist was asked for while we were waiting, ask for it now.
+		if (queuedRangeStart !== null)
+		{
+			var queuedStart = queuedRangeStart;
+			queuedRangeStart = null;
+			requestPlaylistRange(queuedStart);
+		}
+	});
+
+	socket.on("playlist_changes", function(changes, version)
+	{
+		// We missed some changes while we were disconnected. Apply them in order.
+		changes.forEach(applyPlaylistChange);
+		playlistVersion = version;
 		updatePlaylistElement();
 	});
 
-	socket.on("video_added", function(entry, index)
+	socket.on("video_added", function(entry, index, version)
 	{
-		// Videos were added. Add them to the playlist.
-		// data.entries.forEach(function(video, index)
-		// {
-			// The index for each entry added should be the index of the first one 
-			// plus the index of the entry in the entries list.
-			addPlaylistEntry(entry, index);
-		// });
+		if (!acceptPlaylistVersion(version))
+			return;
+		videosAdded([entry], index);
 		updatePlaylistElement();
 	});
 
-	socket.on("videos_removed", function(indices)
+	socket.on("videos_added", function(entries, index, version)
 	{
-		// Videos were removed. Remove them from the playlist.
-		// This is a bit complicated, because if we just start removing indices,
-		// the index of everything after what we've just removed will change.
-		// To get around this issue, we need to remove the highest indices first.
-		indices.sort(function(a, b)
-		{
-			// If a is greater, a comes first.
-			if (a > b)
-				return -1;
-			// If b is greater, b comes first.
-			else if (a < b)
-				return 1;
-			// If they're equal, return 0.
-			else
-				return 0;
-		});
+		if (!acceptPlaylistVersion(version))
+			return;
+		videosAdded(entries, index);
+		updatePlaylistElement();
+	});
 
-		// Now that the list of indices is sorted with greater indices first,
-		// we can just go through it and remove everything.
-		indices.forEach(function(index)
-		{
-			removePlaylistEntry(index, false);
+	socket.on("videos_removed", function(indices, version)
+	{
+		if (!acceptPlaylistVersion(version))
+			return;
+		videosRemoved(indices);
+		updatePlaylistElement();
+	});
 
-			// If the index we're removing is less than the index of the currently playing video, 
-			// we'll need to decrement playlist_pos too.
-			if (index < playlist_pos)
-				playlist_pos--;
-		});
+	socket.on("video_moved", function(old_index, new_index, version)
+	{
+		if (!acceptPlaylistVersion(version))
+			return;
+		videoMoved(old_index, new_index);
 		updatePlaylistElement();
 	});
 
-	socket.on("video_moved", function(old_index, new_index)
+	socket.on("identity", function(user)
 	{
-		// TODO: Implement video moved.
-		socket.emit("reload_playlist");
+		myUsername = user.username;
 	});
 
 	socket.on("userlist_update", function(userlist)
@@ -254,6 +283,20 @@ function initWebSocket()
 		updateUserListTable();
 	});
 
+	socket.on("user_joined", function(user)
+	{
+		// Make sure we don't list the user twice.
+		if (findUserListEntry(user.username) === -1)
+			addUserListEntry(user, userlistObj.length);
+	});
+
+	socket.on("user_left", function(username)
+	{
+		var index = findUserListEntry(username);
+		if (index !== -1)
+			removeUserListEntry(index);
+	});
+
 	socket.on("chat_message", function(message, from_user, action)
 	{
 		postChatMessage(message, from_user, action);
@@ -333,6 +376,9 @@ var guestRegex = /Guest \d+/;
 
 var userlistObj = [];
 
+// The name of the user we're logged in as. The server sends this when we join the room.
+var myUsername;
+
 function updateUserListTable()
 {
 	$("#userlist-body").html("");
@@ -383,7 +429,7 @@ function addUserListEntry(data, index, shouldUpdateUserList)
 {
 	var entry = {
 		name: data.username,
-		isyou: data.isyou,
+		isyou: data.username === myUsername,
 		isguest: data.isguest,
 		isadmin: data.isadmin,
 		isowner: data.isowner,
@@ -394,6 +440,25 @@ function addUserListEntry(data, index, shouldUpdateUserList)
 		updateUserListTable();
 }
 
+function removeUserListEntry(index, shouldUpdateUserList)
+{
+	userlistObj.splice(index, 1);
+
+	if (shouldUpdateUserList === undefined || shouldUpdateUserList === true)
+		updateUserListTable();
+}
+
+// Returns the index of the user with the given name in the user list, or -1 if they're not in it.
+function findUserListEntry(username)
+{
+	for (var i = 0; i < userlistObj.length; i++)
+	{
+		if (userlistObj[i].name === username)
+			return i;
+	}
+	return -1;
+}
+
 
 ////////////////////////
 //// PLAYLIST LOGIC ////
@@ -405,12 +470,75 @@ var playlistObj = [];
 // Index of the currently playing video in the playlist.
 var playlist_pos = -1;
 
+// Version of the playlist that playlistObj is up to date with. Null until the playlist has been loaded.
+var playlistVersion = null;
+
+// Total duration of the videos in the playlist, in seconds.
+var playlistDuration = 0;
+
+// Number of entries to ask the server for at a time. The server won't send more than 100.
+var PLAYLIST_RANGE_SIZE = 100;
+
+// True while we're waiting for the server to send part of the playlist.
+var rangeRequested = false;
+
+// Start of the latest part of the playlist that was asked for while we were waiting, or null if there isn't one.
+var queuedRangeStart = null;
+
+// Asks the server for the part of the playlist starting at the given index.
+// Only one request is sent at a time. If one is already pending, this one is sent once it's answered.
+function requestPlaylistRange(start)
+{
+	if (rangeRequested)
+	{
+		queuedRangeStart = start;
+		return;
+	}
+	rangeRequested = true;
+	socket.emit("playlist_range", start, PLAYLIST_RANGE_SIZE);
+}
+
+// Forgets about any requests for parts of the playlist that haven't been answered.
+function resetPlaylistRequests()
+{
+	rangeRequested = false;
+	queuedRangeStart = null;
+}
+
+// Fills in the given entries in the playlist, starting at the given index. This doesn't update the playlist element.
+function setPlaylistEntries(start, entries)
+{
+	entries.forEach(function(video, offset)
+	{
+		if (start + offset < playlistObj.length)
+			playlistObj[start + offset] = playlistEntryFromVideo(video);
+	});
+}
+
 // Re-builds the playlist table body element.
+// Entries that haven't been loaded are shown as a single row that loads them when it's clicked.
 function updatePlaylistElement()
 {
 	$("#playlist-body").html("");
-	playlistObj.forEach(function(entry, index)
+	for (var index = 0; index < playlistObj.length; index++)
 	{
+		var entry = playlistObj[index];
+		if (entry === null)
+		{
+			// Find the end of this run of entries that haven't been loaded.
+			var runStart = index;
+			while (index + 1 < playlistObj.length && playlistObj[index + 1] === null)
+				index++;
+
+			var loadLnk = $("<a href='#'>" + (index - runStart + 1) + " more videos</a>").click(runStart, function(evt)
+			{
+				evt.preventDefault();
+				requestPlaylistRange(evt.data);
+			});
+			$("#playlist-body").append($("<tr>").append($("<td colspan='6' class='italic'>").append(loadLnk)));
+			continue;
+		}
+
 		var changeVideoClickFunc = function(evt)
 		{
 			evt.preventDefault();
@@ -425,11 +553,36 @@ function updatePlaylistElement()
 			socket.emit("remove_video", clickedindex);
 		};
 
+		// Dragging a row onto another row moves the video there.
+		var dragStartFunc = function(evt)
+		{
+			evt.originalEvent.dataTransfer.effectAllowed = "move";
+			evt.originalEvent.dataTransfer.setData("text", String(evt.data));
+		};
+
+		var dragOverFunc = function(evt)
+		{
+			// Cancelling dragover is what allows dropping on the row.
+			evt.preventDefault();
+		};
+
+		var dropFunc = function(evt)
+		{
+			evt.preventDefault();
+			var oldIndex = parseInt(evt.originalEvent.dataTransfer.getData("text"), 10);
+			var newIndex = evt.data;
+			if (!isNaN(oldIndex) && oldIndex !== newIndex)
+				socket.emit("move_video", oldIndex, newIndex);
+		};
+
 		// Build the rows and columns of the table.
-		var row = $("<tr id='plist-" + index + "'>");
+		var row = $("<tr id='plist-" + index + "' draggable='true'>");
+		row.on("dragstart", null, index, dragStartFunc);
+		row.on("dragover", dragOverFunc);
+		row.on("drop", null, index, dropFunc);
 		var titleCol = $("<td class='trunc-extra'>");
 		var authorCol= $("<td class='trunc-extra'>" + entry.author + "</td>");
-		var timeCol  = $("<td class='text-right'>" + getTimeStr(entry.duration) + "</td>");
+		var timeCol  = $("<td class='text-right'>" + (entry.duration === null ? "" : getTimeStr(entry.duration)) + "</td>");
 		var idCol    = $("<td class='monospace'></td>");
 		var byCol    = $("<td class='trunc-extra'>");
 		var closeCol = $("<td>");
@@ -471,11 +624,31 @@ function updatePlaylistElement()
 		}
 
 		$("#playlist-body").append(row);
-	});
+	}
+
+	if (playlistObj.length > 0)
+	{
+		var summaryCol = $("<td colspan='6' class='italic'>");
+		summaryCol.text(playlistObj.length + " videos, " + getTimeStr(playlistDuration) + " total");
+		$("#playlist-body").append($("<tr>").append(summaryCol));
+	}
 
 	updateSkipButtonsState();
 }
 
+// Returns a playlist entry object for the given entry info from the server.
+// Videos that don't exist anymore have a null title, author, and duration.
+function playlistEntryFromVideo(video)
+{
+	return {
+		id: video.video_id,
+		title: video.title === null ? "Unavailable video" : video.title,
+		author: video.author === null ? "" : video.author,
+		duration: video.duration,
+		added_by: video.added_by,
+	};
+}
+
 // Adds a new playlist entry for the given video ID.
 // If shouldUpdatePlaylist is true or unspecified, updatePlaylistElement will be called.
 function addPlaylistEntry(video, index, shouldUpdatePlaylist)
@@ -483,15 +656,9 @@ function addPlaylistEntry(video, index, shouldUpdatePlaylist)
 	if (video === undefined || video === null)
 		return;
 
-	var entry = {
-		id: video.video_id,
-		title: video.title,
-		author: video.author,
-		duration: video.duration,
-		added_by: video.added_by,
-	};
-	console.log(video)
+	var entry = playlistEntryFromVideo(video);
 	playlistObj.splice(index, 0, entry);
+	playlistDuration += entry.duration || 0;
 
 	if (shouldUpdatePlaylist === undefined || shouldUpdatePlaylist === true)
 		updatePlaylistElement();
@@ -508,9 +675,104 @@ function addPlaylistEntry(video, index, shouldUpdatePlaylist)
 	// });
 }
 
+// Checks the version sent with a playlist change against ours. Returns true if the change should be applied.
+// Changes we already have are ignored, and if we've missed one, the whole playlist is reloaded instead.
+function acceptPlaylistVersion(version)
+{
+	if (playlistVersion !== null)
+	{
+		if (version <= playlistVersion)
+			return false;
+
+		if (version != playlistVersion + 1)
+		{
+			socket.emit("reload_playlist");
+			return false;
+		}
+	}
+	playlistVersion = version;
+	return true;
+}
+
+// Applies a change from the playlist change log. This doesn't update the playlist element.
+function applyPlaylistChange(change)
+{
+	if (change.change_type == "add")
+		videosAdded([change.entry], change.index);
+	else if (change.change_type == "add_many")
+		videosAdded(change.entries, change.index);
+	else if (change.change_type == "remove")
+		videosRemoved(change.indices);
+	else if (change.change_type == "move")
+		videoMoved(change.old_index, change.new_index);
+}
+
+// Adds the given videos to the playlist, in order, starting at index. This doesn't update the playlist element.
+function videosAdded(entries, index)
+{
+	// If they were added before the current video, it gets pushed down by however many were added.
+	if (index < playlist_pos || (index == playlist_pos && playlist_pos < playlistObj.length))
+		playlist_pos += entries.length;
+
+	entries.forEach(function(video, offset)
+	{
+		addPlaylistEntry(video, index + offset, false);
+	});
+}
+
+// Removes the videos at the given indices from the playlist. This doesn't update the playlist element.
+function videosRemoved(indices)
+{
+	// This is a bit complicated, because if we just start removing indices,
+	// the index of everything after what we've just removed will change.
+	// To get around this issue, we need to remove the highest indices first.
+	indices.sort(function(a, b)
+	{
+		// If a is greater, a comes first.
+		if (a > b)
+			return -1;
+		// If b is greater, b comes first.
+		else if (a < b)
+			return 1;
+		// If they're equal, return 0.
+		else
+			return 0;
+	});
+
+	// Now that the list of indices is sorted with greater indices first,
+	// we can just go through it and remove everything.
+	indices.forEach(function(index)
+	{
+		removePlaylistEntry(index, false);
+
+		// If the index we're removing is less than the index of the currently playing video, 
+		// we'll need to decrement playlist_pos too.
+		if (index < playlist_pos)
+			playlist_pos--;
+	});
+}
+
+// Moves the video at old_index in the playlist to new_index. This doesn't update the playlist element.
+function videoMoved(old_index, new_index)
+{
+	playlistObj.splice(new_index, 0, playlistObj.splice(old_index, 1)[0]);
+
+	// Keep playlist_pos pointing at the same video.
+	if (old_index == playlist_pos)
+		playlist_pos = new_index;
+	else if (old_index < playlist_pos && playlist_pos <= new_index)
+		playlist_pos--;
+	else if (new_index <= playlist_pos && playlist_pos < old_index)
+		playlist_pos++;
+}
+
 function removePlaylistEntry(index, shouldUpdatePlaylist)
 {
-	playlistObj.splice(index, 1);
+	// We only know how long the video was if its entry was loaded. If it wasn't, the total
+	// duration is a little off until the next time part of the playlist is loaded.
+	var entry = playlistObj.splice(index, 1)[0];
+	if (entry !== null)
+		playlistDuration -= entry.duration || 0;
 
 	if (shouldUpdatePlaylist === undefined || shouldUpdatePlaylist === true)
 		updatePlaylistElement();
@@ -518,9 +780,32 @@ function removePlaylistEntry(index, shouldUpdatePlaylist)
 
 
 // Adds the given video ID or URL to the playlist. Shows an error if it isn't valid.
+// Several IDs or URLs separated by spaces or commas are added all at once,
+// and a YouTube playlist URL imports the videos in the playlist.
 // This is for when a user adds a video via the UI.
 function addVideoToPlaylist(video, index)
 {
+	var videos = video.split(/[\s,]+/).filter(function(v) { return v.length > 0; });
+
+	if (videos.length > 1)
+	{
+		var vids = videos.map(getVIDFromURL);
+		if (vids.indexOf(undefined) != -1)
+		{
+			alert("\"" + videos[vids.indexOf(undefined)] + "\" isn't a valid YouTube video URL or ID.");
+			return;
+		}
+		addVideos(vids, index);
+		return;
+	}
+
+	var playlistId = getPlaylistIDFromURL(video);
+	if (playlistId !== undefined)
+	{
+		addVideos(playlistId, index);
+		return;
+	}
+
 	vid = getVIDFromURL(video);
 
 	if (vid === undefined)
@@ -541,6 +826,32 @@ function addVideoToPlaylist(video, index)
 	showAddVideoForm(false);
 }
 
+// Sends the server either a list of video IDs or the ID of a YouTube playlist to add to the playlist all at once.
+function addVideos(videos, index)
+{
+	if (index === undefined)
+	{
+		socket.emit("add_videos", videos);
+	}
+	else
+	{
+		socket.emit("add_videos", videos, playlist_pos + 1);
+	}
+
+	showAddVideoForm(false);
+}
+
+// Determines the given URL's playlist ID.
+// Returns undefined if the URL isn't a YouTube playlist URL. URLs of videos in a playlist count as video URLs.
+function getPlaylistIDFromURL(video)
+{
+	urlData = parseURL(video);
+
+	if (urlData.host.toLowerCase().indexOf("youtube") != -1 && urlData.params.v === undefined)
+		return urlData.params.list;
+	return undefined;
+}
+
 // Determines the given URL's video ID.
 function getVIDFromURL(video)
 {
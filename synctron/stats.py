@@ -0,0 +1,55 @@
+# Copyright (C) 2013 Screaming Cats
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Periodic logging of this worker's cache statistics.
+
+The caches count their hits and misses as they go. Every STATS_LOG_INTERVAL seconds, the counters are
+written to the log, so they can be compared over time and between workers.
+"""
+
+from synctron import app
+from synctron.roomstate import room_state_stats
+from synctron.vidinfo import video_info_stats
+
+from gevent import sleep as gevent_sleep
+
+import json
+
+# How often (in seconds) the cache statistics are logged.
+STATS_LOG_INTERVAL = app.config.get("STATS_LOG_INTERVAL", 300)
+
+def log_stats():
+	"""
+	Writes the current cache statistics to the log.
+	"""
+	app.logger.info("Room state cache stats: %s" % json.dumps(room_state_stats(), sort_keys=True))
+	app.logger.info("Video info cache stats: %s" % json.dumps(video_info_stats(), sort_keys=True))
+
+def stats_greenlet():
+	"""
+	Greenlet that logs the cache statistics every STATS_LOG_INTERVAL seconds.
+	"""
+	while True:
+		gevent_sleep(STATS_LOG_INTERVAL)
+		try:
+			log_stats()
+		except:
+			app.logger.error("Exception logging cache stats.", exc_info=True)
@@ -18,57 +18,263 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from synctron import app
+from synctron import app, red
 
 from apiclient.discovery import build
 from apiclient.errors import HttpError
 
 from isodate import parse_duration
 
+from gevent.event import AsyncResult
+
+from collections import OrderedDict
+import json
+import time
+
 yt_service = build("youtube", "v3", developerKey=app.config.get("YT_API_KEY"))
 
 """
 A set of functions for getting (and caching) information about YouTube videos.
+
+Video info is cached in two tiers. Each worker keeps a bounded LRU cache of the videos it's
+looked up recently, and behind that, every worker shares a cache in redis, so video info
+that one worker fetched from YouTube can be used by the others, even after a restart.
+Both tiers expire their entries, and both remember video IDs that don't exist (for a
+shorter time) so that bad IDs don't cost a YouTube API request every time they're added.
 """
 
-# Cache of video info. Dictionary maps video info to video ID.
-video_info_cache = {}
+# Maximum number of videos kept in each worker's local cache.
+VIDEO_CACHE_SIZE = app.config.get("VIDEO_CACHE_SIZE", 2048)
+
+# Number of seconds video info is cached for.
+VIDEO_CACHE_TTL = app.config.get("VIDEO_CACHE_TTL", 6 * 60 * 60)
+
+# Number of seconds that video IDs which don't exist are remembered for.
+VIDEO_MISSING_TTL = app.config.get("VIDEO_MISSING_TTL", 10 * 60)
+
+# Maximum number of video IDs that the YouTube API accepts in one videos().list request.
+VIDEO_BATCH_SIZE = 50
+
+# Local cache of video info. Ordered dict mapping video IDs to (expiry time, info) tuples,
+# from least to most recently used. The info is None for videos that don't exist.
+video_info_cache = OrderedDict()
+
+# Dict mapping the IDs of videos that are currently being looked up to AsyncResults for their info.
+# If a video is already being looked up, anything else that needs it waits for that lookup instead
+# of starting another one.
+_in_flight = {}
+
+# Counters for the video info cache.
+# local_hits and shared_hits count lookups answered by each tier, coalesced counts lookups that
+# waited for a lookup that was already in flight, misses count lookups that had to go to the
+# YouTube API, and evictions count entries dropped to keep the local cache within VIDEO_CACHE_SIZE.
+video_cache_stats = { "local_hits": 0, "shared_hits": 0, "coalesced": 0, "misses": 0, "evictions": 0, "expirations": 0 }
+
+# Returned by the cache lookups when there's nothing cached for a video.
+# None can't be used for this, because None is what's cached for videos that don't exist.
+_NOT_CACHED = object()
+
+
+def video_key(vid):
+	"""Returns the redis key that the given video's info is cached under."""
+	return "video:%s" % vid
+
+def _cache_locally(vid, info, ttl):
+	"""
+	Stores the given info in the local cache, evicting the least recently used entries if the cache is full.
+	"""
+	video_info_cache.pop(vid, None)
+	video_info_cache[vid] = (time.time() + ttl, info)
+	while len(video_info_cache) > VIDEO_CACHE_SIZE:
+		video_info_cache.popitem(last=False)
+		video_cache_stats["evictions"] += 1
+
+def _get_local(vid):
+	"""
+	Looks the given video up in the local cache.
+	Returns _NOT_CACHED if it isn't cached or its entry has expired.
+	"""
+	cached = video_info_cache.pop(vid, None)
+	if cached is None:
+		return _NOT_CACHED
+
+	expires, info = cached
+	if expires <= time.time():
+		video_cache_stats["expirations"] += 1
+		return _NOT_CACHED
+
+	# Put it back at the most recently used end.
+	video_info_cache[vid] = cached
+	return info
+
+def _ttl_for(info):
+	"""Returns how long the given info should be cached for."""
+	return VIDEO_MISSING_TTL if info is None else VIDEO_CACHE_TTL
+
+def _get_shared_many(vids):
+	"""
+	Looks the given videos up in the shared cache in redis, copying the ones that are found into the local cache.
+	Returns a dict mapping the IDs of the videos that were found to their info.
+	"""
+	infos = {}
+	for vid, data in zip(vids, red.mget([video_key(vid) for vid in vids])):
+		if data is None:
+			continue
+
+		info = json.loads(data)
+		# This can keep the local copy around a little longer than the shared one, but video info
+		# hardly ever changes, so that doesn't matter.
+		_cache_locally(vid, info, _ttl_for(info))
+		infos[vid] = info
+	return infos
+
+def cache_video_infos(infos):
+	"""
+	Stores the given dict of video IDs to video info in both cache tiers.
+	Videos whose info is None are remembered as not existing.
+	"""
+	pipe = red.pipeline(transaction=False)
+	for vid, info in infos.iteritems():
+		pipe.setex(video_key(vid), _ttl_for(info), json.dumps(info))
+		_cache_locally(vid, info, _ttl_for(info))
+	pipe.execute()
+
+def video_info_stats():
+	"""
+	Returns a dict containing the video info cache's counters, its size, and its hit ratio.
+	This is logged periodically by synctron.stats.
+	"""
+	stats = dict(video_cache_stats, size=len(video_info_cache))
+	hits = stats["local_hits"] + stats["shared_hits"] + stats["coalesced"]
+	lookups = hits + stats["misses"]
+	stats["hit_ratio"] = float(hits) / lookups if lookups > 0 else 0.0
+	return stats
+
+
+def _parse_video_item(item):
+	"""Returns a video info dict for the given item from a videos().list response."""
+	return {
+		"video_id": item["id"],
+		"title": item["snippet"]["title"],
+		"author": item["snippet"]["channelTitle"],
+		"duration": parse_duration(item["contentDetails"]["duration"]).total_seconds(),
+	}
+
+def _fetch_video_infos(vids):
+	"""
+	Does YouTube API requests for the given list of video IDs, at most VIDEO_BATCH_SIZE at a time.
+	Returns a dict mapping each video ID to its info, or to None if the video doesn't exist.
+	"""
+	infos = dict.fromkeys(vids)
+	for i in range(0, len(vids), VIDEO_BATCH_SIZE):
+		chunk = vids[i:i + VIDEO_BATCH_SIZE]
+		try:
+			response = yt_service.videos().list(id=",".join(chunk),
+				part="id,snippet,contentDetails",
+				fields="items(id,snippet/title,snippet/channelTitle,contentDetails/duration)").execute()
+		except HttpError:
+			app.logger.error("HttpError occurred when trying to get video info for video IDs %s." % ", ".join(chunk), exc_info=True)
+			raise
+
+		# Videos that don't exist are just left out of the response, so they stay None.
+		for item in response["items"]:
+			infos[item["id"]] = _parse_video_item(item)
+	return infos
+
+def _lookup_uncached(vids):
+	"""
+	Looks up info for the given list of video IDs, which aren't in the local cache.
+	They're looked up in the shared cache with a single redis request, and whatever isn't there
+	either is fetched from YouTube in batches.
+	"""
+	infos = _get_shared_many(vids)
+	video_cache_stats["shared_hits"] += len(infos)
+
+	missing = [vid for vid in vids if vid not in infos]
+	if len(missing) > 0:
+		video_cache_stats["misses"] += len(missing)
+		fetched = _fetch_video_infos(missing)
+		cache_video_infos(fetched)
+		infos.update(fetched)
+	return infos
+
+def get_video_infos(vids):
+	"""
+	Returns a dict mapping each of the given video IDs to a dict containing information about the video.
+	Invalid video IDs map to None.
+
+	Only one lookup is ever in flight for each video. If another greenlet is already looking up
+	one of the given videos, this waits for its result rather than looking the video up again.
+	"""
+	infos = {}
+	waiting = {}
+	missing = []
+	for vid in set(vids):
+		info = _get_local(vid)
+		if info is not _NOT_CACHED:
+			video_cache_stats["local_hits"] += 1
+			infos[vid] = info
+		elif vid in _in_flight:
+			waiting[vid] = _in_flight[vid]
+		else:
+			missing.append(vid)
+
+	if len(missing) > 0:
+		results = dict((vid, AsyncResult()) for vid in missing)
+		_in_flight.update(results)
+		try:
+			looked_up = _lookup_uncached(missing)
+		except Exception as e:
+			# Anything waiting on these videos gets the same error.
+			for result in results.itervalues():
+				result.set_exception(e)
+			raise
+		else:
+			for vid, result in results.iteritems():
+				result.set(looked_up[vid])
+			infos.update(looked_up)
+		finally:
+			for vid in missing:
+				del _in_flight[vid]
+
+	for vid, result in waiting.iteritems():
+		video_cache_stats["coalesced"] += 1
+		infos[vid] = result.get()
+	return infos
+
+def get_playlist_video_ids(playlist_id, limit):
+	"""
+	Does YouTube API requests and returns a list of the IDs of the videos in the given YouTube playlist,
+	up to the given limit.
+	If the given playlist ID is not a valid YouTube playlist ID, returns None.
+	"""
+	video_ids = []
+	params = { "playlistId": playlist_id, "part": "contentDetails", "fields": "nextPageToken,items(contentDetails/videoId)" }
+	while len(video_ids) < limit:
+		params["maxResults"] = min(VIDEO_BATCH_SIZE, limit - len(video_ids))
+		try:
+			response = yt_service.playlistItems().list(**params).execute()
+		except HttpError as e:
+			if e.resp.status == 404:
+				return None
+			app.logger.error("HttpError occurred when trying to get the videos in playlist ID %s." % playlist_id, exc_info=True)
+			raise
+
+		video_ids.extend(item["contentDetails"]["videoId"] for item in response["items"])
+
+		if "nextPageToken" not in response:
+			break
+		params["pageToken"] = response["nextPageToken"]
+	return video_ids
 
 def get_video_info(vid):
 	"""
-	Does a YouTube API request and returns a dict containing information about the video.
+	Returns a dict containing information about the given video, doing a YouTube API request if it isn't cached.
 	If the given video ID is not a valid YouTube video ID, returns None.
 	"""
 
-	if vid in video_info_cache:
-		return video_info_cache[vid]
-
 	if vid is None:
 		app.logger.error("Video ID passed to get_video_info is None.")
 		return None
 
-	response = None
-	try:
-		response = yt_service.videos().list(id=vid, 
-			part="id,snippet,contentDetails",
-			fields="items(id,snippet/title,snippet/channelTitle,contentDetails/duration)").execute()
-	except HttpError:
-		app.logger.error("HttpError occurred when trying to get video info for video ID %s." % vid, exc_info=True)
-		raise
-
-	# If items are returned, the video doesn't exist. We should return None.
-	if len(response["items"]) == 0:
-		return None
-
-	# Otherwise, get some info from the response.
-	else:
-		item = response["items"][0]
-
-		video_info_cache[vid] = {
-			"video_id": item["id"],
-			"title": item["snippet"]["title"],
-			"author": item["snippet"]["channelTitle"],
-			"duration": parse_duration(item["contentDetails"]["duration"]).total_seconds(),
-		}
-		return video_info_cache[vid]
-
+	return get_video_infos([vid])[vid]